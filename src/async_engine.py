@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from read_planner import ScanReport
+from transport import deviceTransport
+
+logger = logging.getLogger('Modbus')
+
+MAX_BACKOFF_CYCLES = 16
+
+
+class Target():
+    def __init__(self, port, unit=1):
+        self.port = port
+        self.unit = unit
+        self.readers = []
+        self.failures = 0
+        self.skip = 0
+
+    @property
+    def tag(self):
+        port = self.port.replace("\\", "/").rstrip("/").split("/")[-1]
+        return f"{port}_u{self.unit}"
+
+    @classmethod
+    def parse(cls, text):
+        # "COM2:1" or "/dev/ttyUSB0:3", the unit id defaults to 1
+        port, _, unit = text.strip().rpartition(":")
+        if not port or not unit.isdigit():
+            return cls(text.strip())
+        return cls(port, int(unit))
+
+    def __repr__(self):
+        return f"{self.port}:{self.unit}"
+
+
+class DeviceResult():
+    def __init__(self, target, reader, report, timestamp, error=None):
+        self.target = target
+        self.type = reader.type
+        self.reader = reader
+        self.raw = reader.raw if error is None else []
+        self.values = reader.values if error is None else []
+        self.report = report
+        self.timestamp = timestamp
+        self.error = error
+
+    def __repr__(self):
+        state = self.error if self.error is not None else f"{len(self.values)} values"
+        return f"DeviceResult({self.target!r}, {self.type}, {state})"
+
+
+class PortWorker():
+    # owns one bus: all requests for its targets go through a single queue and a single thread
+    def __init__(self, port, client, targets, on_result):
+        self.port = port
+        self.client = client
+        self.targets = targets
+        self.on_result = on_result
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bus-{port}")
+        self.queue = asyncio.Queue()
+
+    def readDevice(self, target, reader):
+        report = ScanReport(reader.type)
+        timestamp = time.time()
+        started = time.perf_counter()
+        values = reader.planner.execute(deviceTransport(self.client, target.unit), report)
+        if reader.metrics is not None:
+            labels = (("reader", reader.type), ("target", target.tag))
+            reader.metrics.observe("nulite_scan_seconds", labels, time.perf_counter() - started)
+            reader.metrics.inc("nulite_scans_total", labels)
+        if not any(values.valid):
+            return DeviceResult(target, reader, report, timestamp, f"no response after {report.requests} requests")
+        reader.decode(values)
+        return DeviceResult(target, reader, report, timestamp)
+
+    def schedule(self):
+        for target in self.targets:
+            if target.skip > 0:
+                # a dead unit is only retried every few cycles so it does not eat the bus time of the others
+                target.skip -= 1
+                continue
+            for reader in target.readers:
+                self.queue.put_nowait((target, reader))
+
+    async def drain(self):
+        loop = asyncio.get_running_loop()
+        while not self.queue.empty():
+            target, reader = self.queue.get_nowait()
+            if target.skip > 0:
+                # the unit failed earlier in this cycle, its remaining readers would only time out as well
+                continue
+            result = await loop.run_in_executor(self.executor, self.readDevice, target, reader)
+            if result.error is None:
+                target.failures = 0
+            else:
+                target.failures += 1
+                target.skip = min(2 ** (target.failures - 1), MAX_BACKOFF_CYCLES)
+                logger.error(f"{target!r} {reader.type}: {result.error}, skipping {target.skip} cycles")
+            self.on_result(result)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+
+class PollingEngine():
+    def __init__(self, targets, client_factory, reader_factories, on_result=None):
+        # client_factory(port) creates the modbus client of a bus,
+        # reader_factories are callables (client, target) -> reader, one reader per factory and target
+        self.targets = targets
+        self.results = []
+        self.on_result = on_result if on_result is not None else self.results.append
+        self.workers = []
+        ports = {}
+        for target in targets:
+            ports.setdefault(target.port, []).append(target)
+        for port, port_targets in ports.items():
+            client = client_factory(port)
+            for target in port_targets:
+                target.readers = [factory(client, target) for factory in reader_factories]
+            self.workers.append(PortWorker(port, client, port_targets, self.on_result))
+
+    async def cycle(self):
+        started = time.monotonic()
+        for worker in self.workers:
+            worker.schedule()
+        await asyncio.gather(*(worker.drain() for worker in self.workers))
+        return time.monotonic() - started
+
+    async def run(self, cycles=1, interval=0):
+        # cycles=0 polls until cancelled
+        count = 0
+        while cycles == 0 or count < cycles:
+            duration = await self.cycle()
+            count += 1
+            logger.info(f"poll cycle {count} over {len(self.workers)} ports took {duration:.2f}s")
+            if cycles == 0 or count < cycles:
+                if 0 < interval < duration:
+                    logger.warning(f"poll cycle overrun by {duration - interval:.2f}s")
+                await asyncio.sleep(max(interval - duration, 0))
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
@@ -0,0 +1,71 @@
+import sys
+import random
+import logging
+import argparse
+import timeit
+
+import register_map
+from read_planner import RegisterImage
+from read_heat_pump_values import ParameterReader, MeasValuesReader, logger
+
+
+def legacy_decode(reader, image):
+    # the per register path as it was before the register map was compiled
+    data = []
+    for parameter in reader.registers:
+        register_value = image[parameter[0]]
+        value = reader.convert(register_value, parameter[3], parameter[4])
+        logger.debug(f"register {parameter[0]}, scaled value {value}")
+        if type(value) is int:
+            data.append(f"{parameter[1]}, {value}, {parameter[2]}, {parameter[0]}, {register_value}")
+        else:
+            data.append(f"{parameter[1]}, {value:.2f}, {parameter[2]}, {parameter[0]}, {register_value}")
+    return data
+
+
+def compiled_decode(reader, image):
+    reader.decode(image)
+
+
+def compiled_decode_and_format(reader, image):
+    reader.decode(image)
+    return reader.data
+
+
+def measure(function, reader, image, number, repeat):
+    times = timeit.repeat(lambda: function(reader, image), number=number, repeat=repeat)
+    return 1e6 * min(times) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Micro benchmark of the per register decode path against the compiled register map"
+    )
+    parser.add_argument("-n", "--number", dest="number", default=2000, type=int, help="Scans per measurement")
+    parser.add_argument("-r", "--repeat", dest="repeat", default=5, type=int, help="Measurements, the best one is reported")
+    parser.add_argument("--no-numpy", dest="no_numpy", action="store_true", help="Use the pure python batched decode")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    if args.no_numpy:
+        register_map.np = None
+    print(f"numpy: {'no' if register_map.np is None else register_map.np.__version__}")
+    print(f"{'reader':<12}{'registers':>10}{'legacy':>12}{'compiled':>12}{'+format':>12}{'speedup':>10}")
+
+    random.seed(0)
+    for reader_class in (ParameterReader, MeasValuesReader):
+        reader = reader_class(None)
+        image = RegisterImage(reader.planner.size)
+        image.store(0, [random.randrange(65536) for _ in range(reader.planner.size)])
+        if legacy_decode(reader, image) != compiled_decode_and_format(reader, image):
+            print(f"{reader.type}: decode paths disagree")
+            sys.exit(1)
+        legacy = measure(legacy_decode, reader, image, args.number, args.repeat)
+        compiled = measure(compiled_decode, reader, image, args.number, args.repeat)
+        formatted = measure(compiled_decode_and_format, reader, image, args.number, args.repeat)
+        print(f"{reader.type:<12}{len(reader.registers):>10}{legacy:>10.1f}us{compiled:>10.1f}us"
+              f"{formatted:>10.1f}us{legacy / compiled:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
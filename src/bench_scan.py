@@ -0,0 +1,129 @@
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import multiprocessing
+
+from simulator import NuliteSimulator
+from register_map import loadRegisterPlan, DEFAULT_SOURCE
+from read_planner import ScanReport
+from transport import deviceTransport
+from read_heat_pump_values import ParameterReader, MeasValuesReader, ModbusClient, logger
+
+# read plans that are compared: name -> (max_gap, max_count)
+PLANS = {"coalesced": (8, 125), "blocks": (8, 5)}
+
+
+def serveSimulator(connection, options):
+    # runs in its own process, so the cpu time of the simulated slave does not count for the master
+    simulator = NuliteSimulator(loadRegisterPlan(options["map"]), baudrate=options["baud"], turnaround=options["turnaround"],
+                                timeout_rate=options["timeout_rate"], exception_rate=options["exception_rate"]).start()
+    connection.send(simulator.port)
+    connection.recv()
+    simulator.stop()
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(int(share * len(ordered)), len(ordered) - 1)]
+
+
+def scan(reader):
+    report = ScanReport(reader.type)
+    values = reader.planner.execute(deviceTransport(reader.client, reader.unit), report)
+    reader.decode(values)
+    return report
+
+
+def benchmark(reader, scans):
+    latencies, cpu_times, requests, wire_bytes, retries, failures = [], [], [], [], [], 0
+    for _ in range(scans):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        report = scan(reader)
+        if report.failed > 0:
+            failures += 1
+        latencies.append(time.perf_counter() - started)
+        cpu_times.append(time.process_time() - cpu_started)
+        requests.append(report.requests)
+        wire_bytes.append(report.bytes_sent + report.bytes_received)
+        retries.append(report.retries)
+    return {"scans": scans,
+            "failures": failures,
+            "latency_p50_ms": 1000 * percentile(latencies, 0.5),
+            "latency_p90_ms": 1000 * percentile(latencies, 0.9),
+            "latency_p99_ms": 1000 * percentile(latencies, 0.99),
+            "requests_per_scan": sum(requests) / len(requests),
+            "bytes_per_scan": sum(wire_bytes) / len(wire_bytes),
+            "cpu_ms_per_scan": 1000 * sum(cpu_times) / len(cpu_times),
+            "retries_per_scan": sum(retries) / len(retries)}
+
+
+def printResults(results, baseline=None):
+    columns = ("latency_p50_ms", "latency_p90_ms", "latency_p99_ms", "requests_per_scan", "bytes_per_scan", "cpu_ms_per_scan")
+    print(f"{'plan':<11}{'reader':<12}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'req':>7}{'bytes':>8}{'cpu ms':>8}{'retries':>8}{'partial':>8}")
+    for key, result in results.items():
+        plan, type = key.split("/")
+        cells = "".join(f"{result.get(column, float('nan')):>{9 if column.startswith('latency') else 7 if column.startswith('req') else 8}.1f}"
+                        for column in columns)
+        print(f"{plan:<11}{type:<12}{cells}{result.get('retries_per_scan', 0):>8.2f}{result['failures']:>8}")
+        if baseline is not None and key in baseline and "latency_p50_ms" in result and "latency_p50_ms" in baseline[key]:
+            changes = ", ".join(f"{column} {100 * (result[column] / baseline[key][column] - 1):+.0f}%"
+                                for column in columns if baseline[key].get(column))
+            print(f"{'':<23}vs baseline: {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End to end scan benchmark of the readers against the simulated heatpump"
+    )
+    parser.add_argument("-n", "--scans", dest="scans", default=20, type=int, help="Scans per reader and plan")
+    parser.add_argument("--map", dest="map", default=DEFAULT_SOURCE, type=str, help="Register map")
+    parser.add_argument("--baud", dest="baud", default=9600, type=int, help="Baud rate of the simulated line")
+    parser.add_argument("--turnaround", dest="turnaround", default=0.005, type=float, help="Slave turnaround delay in seconds")
+    parser.add_argument("--timeout-rate", dest="timeout_rate", default=0.0, type=float, help="Share of requests left unanswered")
+    parser.add_argument("--exception-rate", dest="exception_rate", default=0.0, type=float, help="Share of requests answered with an exception")
+    parser.add_argument("--plans", dest="plans", default=",".join(PLANS), type=str, help=f"Read plans to compare ({', '.join(PLANS)})")
+    parser.add_argument("--json", dest="json", type=str, help="Write the results to this json file")
+    parser.add_argument("--compare", dest="compare", type=str, help="json results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    options = {"map": args.map, "baud": args.baud, "turnaround": args.turnaround,
+               "timeout_rate": args.timeout_rate, "exception_rate": args.exception_rate}
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serveSimulator, args=(child_connection, options), daemon=True)
+    process.start()
+    port = connection.recv()
+
+    client = ModbusClient(method='rtu', port=port, baudrate=args.baud, parity='N')
+    client.connect()
+    plan = loadRegisterPlan(args.map)
+    results = {}
+    try:
+        for name in args.plans.split(","):
+            max_gap, max_count = PLANS[name]
+            for reader_class in (ParameterReader, MeasValuesReader):
+                reader = reader_class(client, max_gap, max_count, plan=plan)
+                results[f"{name}/{reader.type}"] = benchmark(reader, args.scans)
+    finally:
+        client.close()
+        connection.send("stop")
+        process.join()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)["results"]
+    print(f"{args.scans} scans per reader, {args.baud} baud, turnaround {1000 * args.turnaround:.1f} ms")
+    printResults(results, baseline)
+    if args.json is not None:
+        with open(args.json, "w") as fp:
+            json.dump({"python": platform.python_version(), "baud": args.baud, "turnaround": args.turnaround,
+                       "scans": args.scans, "results": results}, fp, indent=1)
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import logging
+import threading
+import socketserver
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+from read_planner import ReadPlanner, ScanReport, RegisterImage, MAX_READ_COUNT
+from register_map import CompiledRegisterMap
+from transport import deviceTransport
+
+logger = logging.getLogger('Modbus')
+
+# plans of stale register sets that are kept for reuse
+MAX_PLANS = 64
+
+
+class QueryError(ValueError):
+    pass
+
+
+class RegisterCache():
+    # owns the bus: the latest decoded value of every register with a freshness ttl per register,
+    # stale registers are read on demand by the planned block that covers them, concurrent requests for
+    # registers of the same block share one bus transaction
+    def __init__(self, client, plan, ttls=None, default_ttl=5, unit=1, max_gap=8, max_count=MAX_READ_COUNT,
+                 clock=time.monotonic):
+        self.client = client
+        self.plan = plan
+        self.unit = unit
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self.clock = clock
+        self.registers = sorted(plan.registers(), key=lambda parameter: parameter[0])
+        self.register_map = CompiledRegisterMap(self.registers)
+        self.index = {name: index for index, name in enumerate(self.register_map.names)}
+        self.size = max(self.register_map.addresses) + 1 if self.registers else 0
+        ttls = ttls if ttls is not None else {}
+        self.ttls = [ttls.get(name, default_ttl) for name in self.register_map.names]
+        count = len(self.registers)
+        # the blocks of a read plan over the whole map, a stale register is always read with its block
+        positions = {parameter[0]: index for index, parameter in enumerate(self.registers)}
+        self.blocks = [[positions[parameter[0]] for parameter in request.parameters]
+                       for request in ReadPlanner(self.registers, max_gap, max_count).requests]
+        self.block_of = [None] * count
+        for block, members in enumerate(self.blocks):
+            for index in members:
+                self.block_of[index] = block
+        self.raw = [None] * count
+        self.values = [None] * count
+        self.fetched = [None] * count
+        self.timestamps = [None] * count
+        self.pending = {}
+        self.plans = {}
+        self.lock = threading.Lock()
+        self.bus = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.transactions = 0
+
+    def resolve(self, query):
+        # "" / "all", a group name, or comma separated register names
+        query = query.strip().strip("/")
+        if query in ("", "all"):
+            return list(range(len(self.registers)))
+        if query in self.plan.groups:
+            return [self.index[parameter[1]] for parameter in self.plan.groups[query]]
+        names = [name.strip() for name in query.split(",") if name.strip()]
+        unknown = [name for name in names if name not in self.index]
+        if unknown:
+            raise QueryError(f"unknown registers {', '.join(unknown)}")
+        return [self.index[name] for name in names]
+
+    def isFresh(self, index, now):
+        return self.fetched[index] is not None and now - self.fetched[index] < self.ttls[index]
+
+    def get(self, indices):
+        now = self.clock()
+        fetch, wait = [], []
+        with self.lock:
+            for index in indices:
+                block = self.block_of[index]
+                if self.isFresh(index, now):
+                    self.hits += 1
+                elif block in fetch:
+                    self.misses += 1
+                elif block in self.pending:
+                    # another request is already reading the block
+                    self.coalesced += 1
+                    wait.append(self.pending[block])
+                else:
+                    self.misses += 1
+                    fetch.append(block)
+            if fetch:
+                done = threading.Event()
+                for block in fetch:
+                    self.pending[block] = done
+        if fetch:
+            try:
+                self.fetch([index for block in sorted(fetch) for index in self.blocks[block]])
+            finally:
+                with self.lock:
+                    for block in fetch:
+                        self.pending.pop(block, None)
+                done.set()
+        for event in set(wait):
+            event.wait()
+        return self.snapshot(indices)
+
+    def planner(self, indices):
+        key = tuple(indices)
+        planner = self.plans.get(key)
+        if planner is None:
+            if len(self.plans) >= MAX_PLANS:
+                self.plans.clear()
+            planner = self.plans[key] = ReadPlanner([self.registers[index] for index in indices], self.max_gap, self.max_count)
+        return planner
+
+    def fetch(self, indices):
+        report = ScanReport("cache")
+        planner = self.planner(sorted(indices))
+        with self.bus:
+            image = planner.execute(deviceTransport(self.client, self.unit), report)
+            self.transactions += report.requests
+        fetched, timestamp = self.clock(), time.time()
+        full = RegisterImage(self.size)
+        full.registers[:planner.size] = image.registers
+        full.valid[:planner.size] = image.valid
+        raw, values, valid = self.register_map.decode(full)
+        with self.lock:
+            # registers bridged by the requests are refreshed as well
+            for index in range(len(self.registers)):
+                if valid[index]:
+                    self.raw[index] = int(raw[index])
+                    self.values[index] = float(values[index]) if self.register_map.signed[index] else int(raw[index])
+                    self.fetched[index] = fetched
+                    self.timestamps[index] = timestamp
+        logger.debug(f"cache refresh of {len(indices)} registers, scan report {report}")
+
+    def snapshot(self, indices):
+        now = self.clock()
+        result = {}
+        with self.lock:
+            for index in indices:
+                result[self.register_map.names[index]] = {
+                    "value": self.values[index],
+                    "raw": self.raw[index],
+                    "timestamp": self.timestamps[index],
+                    "age": None if self.fetched[index] is None else round(now - self.fetched[index], 3),
+                    "description": self.register_map.descriptions[index],
+                    "register": self.register_map.addresses[index]}
+        return result
+
+    def query(self, query):
+        return self.get(self.resolve(query))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "transactions": self.transactions}
+
+
+class CacheHttpHandler(BaseHTTPRequestHandler):
+    # GET /, /all, /<group>, /C02 or /C02,C03 and /stats
+    def do_GET(self):
+        path = urlparse(self.path).path.strip("/")
+        try:
+            if path == "stats":
+                content = self.server.cache.stats()
+            else:
+                content = self.server.cache.query(path)
+            status = 200
+        except QueryError as _e:
+            content, status = {"error": str(_e)}, 404
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"http {self.address_string()} {format % args}")
+
+
+class CacheSocketHandler(socketserver.StreamRequestHandler):
+    # one query per line, one json answer per line
+    def handle(self):
+        for line in self.rfile:
+            query = line.decode("utf-8").strip()
+            try:
+                content = self.server.cache.stats() if query == "stats" else self.server.cache.query(query)
+            except QueryError as _e:
+                content = {"error": str(_e)}
+            self.wfile.write(json.dumps(content).encode("utf-8") + b"\n")
+
+
+class CacheServer():
+    def __init__(self, cache, http_port=None, socket_path=None, host="127.0.0.1"):
+        self.cache = cache
+        self.servers = []
+        if http_port is not None:
+            server = ThreadingHTTPServer((host, http_port), CacheHttpHandler)
+            server.daemon_threads = True
+            self.servers.append(server)
+            logger.info(f"serving the register cache on http://{host}:{server.server_address[1]}/")
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = socketserver.ThreadingUnixStreamServer(socket_path, CacheSocketHandler)
+            server.daemon_threads = True
+            self.servers.append(server)
+            logger.info(f"serving the register cache on unix socket {socket_path}")
+        for server in self.servers:
+            server.cache = cache
+        self.threads = []
+
+    def start(self):
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever, name="cache-server", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server.server_address, str) and os.path.exists(server.server_address):
+                os.unlink(server.server_address)
+        for thread in self.threads:
+            thread.join()
+        logger.info(f"register cache {self.cache.stats()}")
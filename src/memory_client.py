@@ -0,0 +1,67 @@
+import time
+import threading
+
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from pymodbus.register_write_message import WriteMultipleRegistersResponse, WriteSingleRegisterResponse
+
+
+class MemoryModbusClient():
+    # in-memory stand-in for the ModbusSerialClient of one bus, serving one register bank per unit id
+    def __init__(self, units=None, latency=0.0, timeout=0.1, multiple_writes=True):
+        # multiple_writes=False answers function code 0x10 with illegal function, like a device that only knows 0x06
+        self.units = units if units is not None else {}
+        self.multiple_writes = multiple_writes
+        self.latency = latency
+        self.timeout = timeout
+        self.requests = 0
+        self.busy = threading.Lock()
+
+    def connect(self):
+        return True
+
+    def close(self):
+        pass
+
+    def read_holding_registers(self, address, count, unit=1):
+        def perform(registers):
+            if any(register not in registers for register in range(address, address + count)):
+                return ExceptionResponse(0x03, ModbusExceptions.IllegalAddress)
+            return ReadHoldingRegistersResponse([registers[register] for register in range(address, address + count)])
+        return self.transaction(unit, perform)
+
+    def write_registers(self, address, values, unit=1):
+        def perform(registers):
+            if not self.multiple_writes:
+                return ExceptionResponse(0x10, ModbusExceptions.IllegalFunction)
+            if any(register not in registers for register in range(address, address + len(values))):
+                return ExceptionResponse(0x10, ModbusExceptions.IllegalAddress)
+            for index, value in enumerate(values):
+                registers[address + index] = value
+            return WriteMultipleRegistersResponse(address, len(values))
+        return self.transaction(unit, perform)
+
+    def write_register(self, address, value, unit=1):
+        def perform(registers):
+            if address not in registers:
+                return ExceptionResponse(0x06, ModbusExceptions.IllegalAddress)
+            registers[address] = value
+            return WriteSingleRegisterResponse(address, value)
+        return self.transaction(unit, perform)
+
+    def transaction(self, unit, perform):
+        # a half duplex bus carries one transaction at a time
+        if not self.busy.acquire(blocking=False):
+            raise RuntimeError("concurrent transactions on a half duplex bus")
+        try:
+            self.requests += 1
+            registers = self.units.get(unit)
+            if registers is None:
+                # nobody answers, the master waits for its timeout
+                time.sleep(self.timeout)
+                return ModbusIOException(f"no response from unit {unit}")
+            time.sleep(self.latency)
+            return perform(registers)
+        finally:
+            self.busy.release()
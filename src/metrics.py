@@ -0,0 +1,174 @@
+import sys
+import time
+import bisect
+import pstats
+import cProfile
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger('Modbus')
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# name -> (type, help, buckets)
+DEFINITIONS = {
+    "nulite_request_seconds": ("histogram", "Latency of a modbus transaction, by reader, function and start register of the block", LATENCY_BUCKETS),
+    "nulite_requests_total": ("counter", "Modbus transactions", None),
+    "nulite_bytes_sent_total": ("counter", "Bytes sent on the bus", None),
+    "nulite_bytes_received_total": ("counter", "Bytes received from the bus", None),
+    "nulite_timeouts_total": ("counter", "Transactions without a response", None),
+    "nulite_crc_errors_total": ("counter", "Responses that could not be decoded (crc or framing error)", None),
+    "nulite_exception_responses_total": ("counter", "Exception responses of the heatpump", None),
+    "nulite_scan_seconds": ("histogram", "Duration of a scan, by reader or register group", LATENCY_BUCKETS),
+    "nulite_scans_total": ("counter", "Scans, by reader or register group", None),
+    "nulite_overruns_total": ("counter", "Scan slots skipped because the bus could not keep up", None),
+    "nulite_stage_seconds": ("histogram", "Time spent per processing stage (decode, persist, sink_*)", STAGE_BUCKETS),
+    "nulite_writer_queue_depth": ("gauge", "Scans waiting for the writer thread", None),
+    "nulite_writer_dropped_total": ("counter", "Scans dropped by the backpressure policy of the writer queue", None),
+    "nulite_uptime_seconds": ("gauge", "Seconds since the metrics were started", None),
+}
+
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def formatLabels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in pairs) + "}"
+
+
+class Metrics():
+    # counters, gauges and histograms keyed by name and a tuple of (label, value) pairs; code paths hold a
+    # reference that is None when the instrumentation is disabled, so they only pay for a None check
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram(DEFINITIONS[name][2])
+            histogram.observe(value)
+
+    def render(self):
+        # prometheus text exposition format
+        lines = []
+        with self.lock:
+            self.values[("nulite_uptime_seconds", ())] = round(time.time() - self.started, 1)
+            for name, (type, help, buckets) in DEFINITIONS.items():
+                if type == "histogram":
+                    series = sorted((labels, histogram) for (metric, labels), histogram in self.histograms.items() if metric == name)
+                else:
+                    series = sorted((labels, value) for (metric, labels), value in self.values.items() if metric == name)
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+                for labels, value in series:
+                    if type != "histogram":
+                        lines.append(f"{name}{formatLabels(labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float("inf"),), value.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{formatLabels(labels, (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{formatLabels(labels)} {value.sum:.6f}")
+                    lines.append(f"{name}_count{formatLabels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+class ThreadProfiler():
+    # cProfile only sees the thread that enables it: the bus worker and writer threads started afterwards
+    # get a profile of their own, all of them are merged into one dump
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.setprofile(self.threadStarted)
+        self.profile.enable()
+        return self
+
+    def threadStarted(self, frame, event, arg):
+        # first profile event of a new thread, the hook is replaced by the profile of the thread
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def stop(self, path):
+        threading.setprofile(None)
+        self.profile.disable()
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            for profile in self.profiles:
+                profile.disable()
+                profile.create_stats()
+                if profile.stats:
+                    stats.add(profile)
+        stats.dump_stats(path)
+        logger.info(f"profile of {len(self.profiles) + 1} threads written to {path}")
+
+
+class MetricsHttpHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"metrics {self.address_string()} {format % args}")
+
+
+class MetricsServer():
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        self.server = ThreadingHTTPServer((host, port), MetricsHttpHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = metrics
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+logger = logging.getLogger('Modbus')
+
+# one register of one scan, value is None when the register could not be read
+Sample = namedtuple("Sample", ["series", "timestamp", "name", "value", "raw", "description", "register"])
+
+# what the writer does with a scan when the queue is full
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+_STOP = object()
+
+
+class ScanBatch():
+    # the samples of one scan, plus the register columns for the sinks that store whole scans;
+    # written is called once every sink wrote the scan
+    def __init__(self, series, timestamp, samples, register_map=None, raw=None, valid=None, full=True, written=None):
+        self.series = series
+        self.timestamp = timestamp
+        self.samples = samples
+        self.register_map = register_map
+        self.raw = raw
+        self.valid = valid
+        self.full = full
+        self.written = written
+
+    def __repr__(self):
+        return f"ScanBatch({self.series}, {len(self.samples)} samples{'' if self.full else ', changes'})"
+
+
+def formatSample(sample):
+    # the row layout of ReaderBase.writeDataToFile
+    if sample.value is None:
+        return f"{sample.name}, , {sample.description}, {sample.register}, "
+    value = f"{sample.value:.2f}" if isinstance(sample.value, float) else sample.value
+    return f"{sample.name}, {value}, {sample.description}, {sample.register}, {sample.raw}"
+
+
+class CsvSink():
+    # one csv per scan in the output folder, named after the scan time
+    def __init__(self, output_path):
+        self.output_path = output_path
+
+    def write(self, batches):
+        for batch in batches:
+            base = os.path.join(self.output_path, f"{batch.series}_{datetime.fromtimestamp(batch.timestamp).strftime('%Y-%m-%d_%H-%M-%S')}")
+            path, duplicate = f"{base}.csv", 1
+            while os.path.exists(path):
+                path, duplicate = f"{base}_{duplicate}.csv", duplicate + 1
+            logger.info(f"write data to  {path}")
+            with open(path, "w") as fp:
+                fp.write("name, value, description, register, raw_value \n")
+                for sample in batch.samples:
+                    fp.write(formatSample(sample) + '\n')
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink():
+    # all samples appended to one file, one json object per line
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "a")
+
+    def write(self, batches):
+        for batch in batches:
+            for sample in batch.samples:
+                self.fp.write(json.dumps(sample._asdict()) + "\n")
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class SqliteSink():
+    # one transaction per drained set of scans
+    def __init__(self, path):
+        self.path = path
+        # created in the polling thread, used only by the writer thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS samples (series TEXT, timestamp REAL, name TEXT, "
+                                "value REAL, raw INTEGER, register INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS samples_series_time ON samples (series, timestamp)")
+        self.connection.commit()
+
+    def write(self, batches):
+        with self.connection:
+            self.connection.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)",
+                                        ((sample.series, sample.timestamp, sample.name, sample.value, sample.raw, sample.register)
+                                         for batch in batches for sample in batch.samples))
+
+    def close(self):
+        self.connection.close()
+
+
+class StoreSink():
+    # the binary time series store, gets the register vector of the scan
+    def __init__(self, store):
+        self.store = store
+
+    def write(self, batches):
+        for batch in batches:
+            self.store.append(batch.series, batch.register_map, batch.timestamp, batch.raw, batch.valid)
+
+    def close(self):
+        pass
+
+
+class MqttSink():
+    # publishes every sample to <prefix>/<series>/<name>, retained so a new subscriber sees the last values,
+    # client is anything with publish(topic, payload, qos, retain): a paho client or the LocalBroker
+    def __init__(self, client, prefix="nulite", qos=0):
+        self.client = client
+        self.prefix = prefix
+        self.qos = qos
+
+    def write(self, batches):
+        for batch in batches:
+            for sample in batch.samples:
+                payload = json.dumps({"timestamp": sample.timestamp, "value": sample.value, "raw": sample.raw})
+                self.client.publish(f"{self.prefix}/{sample.series}/{sample.name}", payload, self.qos, True)
+
+    def close(self):
+        disconnect = getattr(self.client, "disconnect", None)
+        if disconnect is not None:
+            disconnect()
+
+
+def topicMatches(topic_filter, topic):
+    # mqtt wildcards: + one level, # the remaining levels
+    filter_levels, levels = topic_filter.split("/"), topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(levels) or (level != "+" and level != levels[index]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+class LocalBroker():
+    # in-process stand-in of a mqtt broker for tests, pass it to MqttSink directly
+    def __init__(self):
+        self.subscriptions = []
+        self.retained = {}
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def subscribe(self, topic_filter, callback):
+        with self.lock:
+            self.subscriptions.append((topic_filter, callback))
+            retained = [(topic, payload) for topic, payload in self.retained.items() if topicMatches(topic_filter, topic)]
+        for topic, payload in retained:
+            callback(topic, payload)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            self.published += 1
+            if retain:
+                self.retained[topic] = payload
+            callbacks = [callback for topic_filter, callback in self.subscriptions if topicMatches(topic_filter, topic)]
+        for callback in callbacks:
+            callback(topic, payload)
+
+
+def connectMqtt(address):
+    # "host" or "host:port"
+    if mqtt is None:
+        raise RuntimeError("publishing to a mqtt broker needs paho-mqtt (pip install paho-mqtt)")
+    host, _, port = address.partition(":")
+    client = mqtt.Client()
+    client.connect(host, int(port) if port else 1883)
+    client.loop_start()
+    return client
+
+
+class WriterPipeline():
+    # scans are handed over to a bounded queue, one background thread fans them out to the sinks,
+    # so disk and network latency never extend the bus cycle
+    def __init__(self, sinks, max_queue=64, policy=DROP_OLDEST, block_timeout=1.0, max_batch=32):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown backpressure policy {policy}, one of {', '.join(POLICIES)}")
+        self.sinks = sinks
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.max_batch = max_batch
+        self.queue = queue.Queue(max_queue)
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.metrics = None
+        self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, batch):
+        self.submitted += 1
+        self.enqueue(batch)
+        if self.metrics is not None:
+            self.metrics.set("nulite_writer_queue_depth", (), self.queue.qsize())
+
+    def enqueue(self, batch):
+        if self.policy == BLOCK:
+            try:
+                self.queue.put(batch, timeout=self.block_timeout)
+            except queue.Full:
+                self.drop(batch)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(batch)
+                return
+            except queue.Full:
+                if self.policy == DROP_NEWEST:
+                    self.drop(batch)
+                    return
+            try:
+                self.drop(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+    def drop(self, batch):
+        self.dropped += 1
+        if self.metrics is not None:
+            self.metrics.inc("nulite_writer_dropped_total")
+        logger.warning(f"writer queue full, {batch} dropped ({self.dropped} dropped so far)")
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = self.queue.get()
+            if batch is _STOP:
+                break
+            batches = [batch]
+            # drain what queued up meanwhile, the sinks write it in one go
+            while len(batches) < self.max_batch:
+                try:
+                    batch = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if batch is _STOP:
+                    stopping = True
+                    break
+                batches.append(batch)
+            self.write(batches)
+
+    def write(self, batches):
+        if self.metrics is not None:
+            self.metrics.set("nulite_writer_queue_depth", (), self.queue.qsize())
+        failed = False
+        for sink in self.sinks:
+            started = time.perf_counter()
+            try:
+                sink.write(batches)
+                if self.metrics is not None:
+                    self.metrics.observe("nulite_stage_seconds", (("stage", f"sink_{type(sink).__name__}"),), time.perf_counter() - started)
+            except Exception as _e:
+                failed = True
+                self.errors += 1
+                logger.error(f"{type(sink).__name__} could not write {len(batches)} scans: {_e}")
+        self.written += len(batches)
+        if failed:
+            return
+        for batch in batches:
+            if batch.written is not None:
+                try:
+                    batch.written()
+                except Exception as _e:
+                    logger.error(f"{batch} written, but its callback failed: {_e}")
+
+    def close(self):
+        # writes what is queued, then closes the sinks
+        self.queue.put(_STOP)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+        logger.info(f"writer: {self}")
+
+    def __repr__(self):
+        return (f"{self.submitted} scans submitted, {self.written} written, {self.dropped} dropped, "
+                f"{self.errors} sink errors, {self.queue.qsize()} queued")
+
+
+def createSinks(names, output_path, store=None, mqtt_address=None, mqtt_prefix="nulite"):
+    # names: comma separated csv, jsonl, sqlite, store, mqtt
+    sinks = []
+    for name in (item.strip() for item in names.split(",") if item.strip()):
+        if name == "csv":
+            sinks.append(CsvSink(output_path))
+        elif name == "jsonl":
+            sinks.append(JsonLinesSink(os.path.join(output_path, "samples.jsonl")))
+        elif name == "sqlite":
+            sinks.append(SqliteSink(os.path.join(output_path, "samples.sqlite")))
+        elif name == "store":
+            sinks.append(StoreSink(store))
+        elif name == "mqtt":
+            if not mqtt_address:
+                raise ValueError("the mqtt sink needs the address of a broker (--mqtt host:port)")
+            sinks.append(MqttSink(connectMqtt(mqtt_address), mqtt_prefix))
+        else:
+            raise ValueError(f"unknown sink {name}")
+    return sinks
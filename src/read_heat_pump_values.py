@@ -1,15 +1,33 @@
 import os
 import sys
+import copy
+import time
+import signal
+import threading
+import asyncio
 import struct
 import logging
 import argparse
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 
+from read_planner import ReadPlanner, ScanReport, MAX_READ_COUNT
+from scheduler import ScanGroup, Scheduler
+from async_engine import PollingEngine, Target
+from transport import deviceTransport
+from register_map import CompiledRegisterMap, RegisterMapError, loadRegisterPlan, DEFAULT_SOURCE
+from ts_store import TimeSeriesStore
+from snapshot_cache import SnapshotCache, parseDeadbands
+from cache_server import RegisterCache, CacheServer
+from param_writer import ParameterWriter, loadDesired, loadSnapshot, WRITE_MAX_COUNT
+from metrics import Metrics, MetricsServer, ThreadProfiler
+from pipeline import Sample, ScanBatch, WriterPipeline, createSinks, POLICIES, DROP_OLDEST
+
 # setup the logger
 logger = logging.getLogger('Modbus')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)
 
 # Formatter for log messages
 formatter = logging.Formatter(
@@ -35,11 +53,24 @@ class debugDummy():
 
 
 class ReaderBase(object):
-    def __init__(self, client, type):
+    def __init__(self, client, type, max_gap=8, max_count=MAX_READ_COUNT, unit=1, plan=None):
         self.client = client
+        self.unit = unit
         self.type = type
-        self.data = []
         self.data_filename = "base.csv"
+        self.raw = []
+        self.values = []
+        self.valid = []
+        self.timestamp = None
+        self.snapshots = None
+        self.pipeline = None
+        self.metrics = None
+        # how a scan is compared against the last persisted one: "deadband" per register or "hash" of the whole scan
+        self.change_detection = "deadband"
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self.report = ScanReport(type)
+        self.plan = plan if plan is not None else loadRegisterPlan()
     
     @property
     def type(self):
@@ -51,11 +82,8 @@ class ReaderBase(object):
 
     @property
     def data(self):
-        return self.__data
-
-    @data.setter
-    def data(self, value):
-        self.__data = value
+        # the csv rows are only formatted when a sink asks for them
+        return self.register_map.formatRows(self.raw, self.values, self.valid)
 
     @property
     def data_filename(self):
@@ -65,15 +93,23 @@ class ReaderBase(object):
     def data_filename(self, value):
         self.__data_filename = value
 
+    @property
+    def readout_dict(self):
+        return self.__readout_dict
 
-    def addValueToDataList(self, value, name, description, register, raw=""):
-        if type(value) is int:
-            self.data.append(f"{name}, {value}, {description}, {register}, {raw}")
-        else:
-            self.data.append(f"{name}, {value:.2f}, {description}, {register}, {raw}")
+    @readout_dict.setter
+    def readout_dict(self, value):
+        # the read plan is computed once, whenever the register map is assigned
+        self.__readout_dict = value
+        self.registers = sorted((parameter for block in value.values() for parameter in block), key=lambda parameter: parameter[0])
+        self.planner = ReadPlanner(self.registers, self.max_gap, self.max_count)
+        self.register_map = CompiledRegisterMap(self.registers)
+        logger.debug(f"{self.type}: {len(self.registers)} registers planned in {len(self.planner.requests)} requests {self.planner.requests}")
 
-    def writeDataToFile(self, file_path):
-        if len(self.data) > 0 and os.path.isdir(file_path):
+    def writeDataToFile(self, file_path, indices=None):
+        data = self.data if indices is None else self.register_map.formatRows(self.raw, self.values, self.valid, indices)
+        # a scan without a single readable register is not persisted
+        if any(self.valid) and os.path.isdir(file_path):
             # Get the current date and time
             now = datetime.now()
             timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
@@ -89,9 +125,74 @@ class ReaderBase(object):
             
             fp = open(os.path.join(file_path), 'w')
             fp.write("name, value, description, register, raw_value \n")
-            for line in self.data:
+            for line in data:
                 fp.write(line + '\n')
             fp.close()
+            return True
+        return False
+
+    def changes(self):
+        # None when the scan does not have to be persisted, otherwise the registers to write (all of them for None)
+        series = os.path.splitext(self.data_filename)[0]
+        if self.change_detection == "hash":
+            if self.snapshots.unchanged(series, self.raw, self.valid):
+                logger.info(f"{self.type} unchanged since the last scan, not persisted")
+                return None
+            return range(len(self.register_map))
+        indices = self.snapshots.changes(series, self.register_map, self.raw, self.values, self.valid, self.timestamp)
+        if indices is None:
+            logger.info(f"{self.type} within the deadbands of the last persisted scan, not persisted")
+        elif len(indices) < len(self.register_map):
+            logger.debug(f"{self.type}: {len(indices)} changed values {[self.register_map.names[index] for index in indices]}")
+        return indices
+
+    def snapshotCommit(self, indices):
+        # moves the snapshot reference to this scan, called only once the scan is written
+        series, snapshots = os.path.splitext(self.data_filename)[0], self.snapshots
+        register_map, raw, values, valid, timestamp = self.register_map, self.raw, self.values, self.valid, self.timestamp
+        if self.change_detection == "hash":
+            return lambda: snapshots.commitDigest(series, raw, valid, timestamp)
+        return lambda: snapshots.commit(series, register_map, values, valid, timestamp, indices)
+
+    def samples(self, indices=None):
+        series = os.path.splitext(self.data_filename)[0]
+        register_map = self.register_map
+        for index in (range(len(register_map)) if indices is None else indices):
+            if not self.valid[index]:
+                value, raw = None, None
+            else:
+                raw = int(self.raw[index])
+                value = float(self.values[index]) if register_map.signed[index] else raw
+            yield Sample(series, self.timestamp, register_map.names[index], value, raw,
+                         register_map.descriptions[index], register_map.addresses[index])
+
+    def batch(self, indices=None, written=None):
+        return ScanBatch(os.path.splitext(self.data_filename)[0], self.timestamp, list(self.samples(indices)),
+                         self.register_map, self.raw, self.valid, indices is None, written)
+
+    def persist(self, file_path):
+        if self.metrics is None:
+            return self.writeScan(file_path)
+        started = time.perf_counter()
+        self.writeScan(file_path)
+        self.metrics.observe("nulite_stage_seconds", (("stage", "persist"), ("reader", self.type)), time.perf_counter() - started)
+
+    def writeScan(self, file_path):
+        # with a writer pipeline the scan is only queued, the sinks (csv, store, ...) write it in the background;
+        # a reader used without a pipeline writes the csv of the scan itself
+        indices, commit = None, None
+        if self.snapshots is not None and any(self.valid):
+            indices = self.changes()
+            if indices is None:
+                return
+            commit = self.snapshotCommit(indices)
+            if len(indices) == len(self.register_map):
+                indices = None
+        if self.pipeline is not None:
+            if any(self.valid):
+                self.pipeline.submit(self.batch(indices, commit))
+        elif self.writeDataToFile(file_path, indices) and commit is not None:
+            commit()
 
     def raw_value(self, register_value):
         return register_value
@@ -106,216 +207,232 @@ class ReaderBase(object):
         else:
             return float(self.scale_value(register_value, scale, offset))
 
+    def unscale_value(self, value, scale, offset):
+        signed_value = round(value / scale - offset)
+        return struct.unpack('H', struct.pack('h', signed_value))[0]
+
+    def unconvert(self, value, scale, offset):
+        # inverse of convert, the raw register value that reads back as value
+        if scale == 0:
+            return struct.unpack('H', struct.pack('H', int(value)))[0]
+        else:
+            return self.unscale_value(value, scale, offset)
+
     def read(self):
         logger.info(f"reading {self.type}")
-        for block in self.readout_dict:
-            start_address = block * 5
-            logger.debug(f"read block {block}, start_address {start_address}, number of words {len(self.readout_dict[block])}")
-#            read_vals  = self.client.read_holding_registers(start_address, 5, unit=1) # start_address, count, slave_id
-            try:
-                read_vals  = self.client.read_holding_registers(start_address, 5, unit=1) # start_address, count, slave_id
-            except Exception as _e:
-                logger.error(f"could not read the value via modbus client {_e}")
-                sys.exit(1)
-                #read_vals = debugDummy()
-            
-            for parameter in self.readout_dict[block]:
-                block_offset = parameter[0] - start_address
-                register_value = read_vals.registers[block_offset]
-                value = self.convert(register_value, parameter[3], parameter[4])
-                logger.debug(f"register {parameter[0]}, block offset {block_offset}, scaled value {value}")
-                self.addValueToDataList(value, parameter[1], parameter[2], parameter[0], register_value )
+        started = time.perf_counter()
+        self.report = ScanReport(self.type)
+        values = self.planner.execute(deviceTransport(self.client, self.unit), self.report)
+        if self.metrics is not None:
+            self.metrics.observe("nulite_scan_seconds", (("reader", self.type),), time.perf_counter() - started)
+            self.metrics.inc("nulite_scans_total", (("reader", self.type),))
+        self.decode(values)
+        self.report.missing = len(self.register_map) - int(sum(self.valid))
+        if self.report.missing == len(self.register_map):
+            logger.error(f"could not read any {self.type} value via modbus client")
+        elif self.report.missing > 0:
+            logger.warning(f"{self.report.missing} {self.type} values could not be read, they are marked missing")
+        logger.info(f"scan report {self.report}")
+
+    def decode(self, values):
+        self.timestamp = time.time()
+        if self.metrics is None:
+            self.raw, self.values, self.valid = self.register_map.decode(values)
+        else:
+            started = time.perf_counter()
+            self.raw, self.values, self.valid = self.register_map.decode(values)
+            self.metrics.observe("nulite_stage_seconds", (("stage", "decode"), ("reader", self.type)), time.perf_counter() - started)
+        if logger.isEnabledFor(logging.DEBUG):
+            for index, register in enumerate(self.register_map.addresses):
+                logger.debug(f"register {register}, raw value {self.raw[index]}, scaled value {self.values[index]}")
+
+    def select(self, type, names):
+        # a reader of the same kind, limited to the given register names
+        reader = copy.copy(self)
+        reader.type = type
+        reader.data_filename = f"{type}.csv"
+        reader.readout_dict = {block: [parameter for parameter in parameters if parameter[1] in names]
+                               for block, parameters in self.readout_dict.items()
+                               if any(parameter[1] in names for parameter in parameters)}
+        return reader
 
 class ParameterReader(ReaderBase):
-    def __init__(self, client):
-        super().__init__(client, "Parameters")
+    def __init__(self, client, max_gap=8, max_count=MAX_READ_COUNT, unit=1, plan=None):
+        super().__init__(client, "Parameters", max_gap, max_count, unit, plan)
         self.data_filename = "Parameters.csv"
-        self.readout_dict = {0: [(0, "P00", "On-off", 0, 0), 
-                                 (1, "P01", "Mode", 0, 0), 
-                                 (2, "P02", "Heating target temperature", 1, 0), 
-                                 (3, "P03", "Cooling target temperature", 1, 0), 
-                                 (4, "P04", "Domestic hot water target temperature", 1, 0)],
-                             1: [(5, "P05", "Indoor target temperature", 1, 0), 
-                                 (6, "P06", "AC water temperature difference", 0.5, 0), 
-                                 (7, "P07", "DHW water temperature difference", 0.5, 0),
-                                 (8, "P08", "Domestic hot water AU option", 0, 0), 
-                                 (9, "P09", "Hot water max frequency", 0, 0)],
-                             2: [(10, "P10", "Sterilization interval days", 0, 0), 
-                                 (11, "P11", "Sterilization start time", 0, 0), 
-                                 (12, "P12", "Sterilization running time", 0, 0), 
-                                 (13, "P13", "Sterilization temperature", 1, 0), 
-                                 (14, "P14", "Force sterilization", 0, 0) ],
-                             3: [(15, "P15", "Domestic hot water function selection", 0, 0), 
-                                 (16, "P16", "Hot water circulation pump working mode", 0, 0), 
-                                 (17, "P17", "Hot water circulating pump starting temperature difference", 1, 0), 
-                                 (18, "P18", "Heating AU maximum temperature", 1, 0), 
-                                 (19, "P19", "Heating AU offset temperature", 1, 0)],
-                             4: [(20, "P20", "Air conditioner heating AU switch", 0, 0),
-                                 (21, "P21", "Night run mode starting time", 0, 0),
-                                 (22, "P22", "Night run mode stop time", 0, 0),
-                                 (23, "P23", "Night run mode active option", 0, 0),
-                                 (24, "P24", "Water pump working mode", 0, 0)],
-                             5: [(25, "P25", "Water pump antifreeze time", 0, 0),
-                                 (26, "P26", "Water pump speed regulation temperature difference", 1, 0),
-                                 (27, "P27", "PWM water pump minimum speed", 0, 0),
-                                 (28, "P28", "Ambient temperature of electric auxiliary heat start of air conditioner", 1, 0),
-                                 (29, "P29", "Hot water and electric auxiliary heat start ambient temperature", 1, 0)],
-                             6: [(30, "P30", "Electric heating stop offset temperature", 1, 0),
-                                 (31, "P31", "E2 connection port function definition", 0, 0),
-                                 (32, "P32", "Second heat source starting temperature", 1, 0),
-                                 (33, "P33", "Air conditioner antifreeze temperature", 1, 0),
-                                 (34, "P34", "defrosting method", 0, 0)],
-                             7: [(35, "P35", "Defrost start temperature", 1, 0),
-                                 (36, "P36", "Defrost Interval Multiplier", 0, 0),
-                                 (37, "P37", "First defrost interval", 0, 0),
-                                 (38, "P38", "Compressor defrost frequency", 0, 0),
-                                 (39, "P39", "Defrost exit temperature", 1, 0)],
-                             8: [(40, "P40", "Maximum defrost time", 0, 0),
-                                 (41, "P41", "defrost mode 2 temp difference", 0, 0),
-                                 (42, "P42", "defrost mode 2 pressure difference", 0.01, 0),
-                                 (43, "P43", "EC fan maximum speed", 0, 0),
-                                 (44, "P44", "Heating fan speed regulation temperature difference", 0, 0)],
-                             9: [(45, "P45", "Cooling fan speed regulation temperature difference", 0, 0),
-                                 (46, "P46", "EC fan speed control", 0, 0),
-                                 (47, "P47", "EC fan manual speed", 0, 0),
-                                 (48, "P48", "Inverter compressor model setting", 0, 0),
-                                 (49, "P49", "Operating the set frequency function", 0, 0)],
-                             10: [(50, "P50", "Debug fixed operating frequency", 0, 0),
-                                  (51, "P51", "Compressor frequency limiting current", 0.1, 0),
-                                  (52, "P52", "Compressor down frequency current", 0.1, 0),
-                                  (53, "P53", "Compressor shutdown current", 0.1, 0),
-                                  (54, "P54", "Compressor maximum frequency", 0, 0)],
-                             11: [(55, "P55", "Compressor minimum frequency", 0, 0),
-                                  (56, "P56", "Air conditioner water flow switch type selection", 0, 0),
-                                  (57, "P57", "Air conditioner minimum water flow", 0, 0),
-                                  (58, "P58", "Air conditioning function selection", 0, 0),
-                                  (59, "P59", "Water source air cooling option", 0, 0)],
-                             12: [(60, "P60", "Power-down recovery function bit", 0, 0),
-                                  (61, "P61", "Main valve control mode", 0, 0),
-                                  (62, "P62", "Main valve initial opening (manual opening adjustment) heating", 0, 0),
-                                  (63, "P63", "Main valve initial opening (manual opening adjustment) cooling", 0, 0),
-                                  (64, "P64", "Main valve superheat (heating)", 0, 0)],
-                             13: [(65, "P65", "Main valve superheat (cooling)", 0, 0),
-                                  (66, "P66", "Enthalpy injection valve control mode", 0, 0),
-                                  (67, "P67", "Initial opening of enthalpy injection valve (manual opening adjustment) for heating", 0, 0),
-                                  (68, "P68", "Enthalpy injection valve opening exhaust temperature (heating)", 1, 0),
-                                  (69, "P69", "Enthalpy injection valve opening exhaust temperature (cooling)", 1, 0)],
-                             14: [(70, "P70", "Enthalpy injection valve closing valve exhaust temperature hysteresis", 1, 0),
-                                  (71, "P71", "Enthalpy injection valve closed valve ambient temperature hysteresis", 1, 0),
-                                  (72, "P72", "Enthalpy injection valve opening ambient temperature (heating)", 1, 0),
-                                  (73, "P73", "Enthalpy injection valve opening ambient temperature (cooling)", 1, 0),
-                                  (74, "P74", "Pressure sensor enable bit", 0, 0)],
-                             15: [(75, "P75", "Air conditioning mode frequency limit pressure", 0.1, 0),
-                                  (76, "P76", "Air-conditioning mode cancels frequency limit pressure", 0.1, 0),
-                                  (77, "P77", "Hot water mode frequency limiting pressure", 0.1, 0),
-                                  (78, "P78", "Hot water mode cancels frequency limit pressure", 0.1, 0),
-                                  (79, "P79", "High pressure protection setting value", 0.1, 0)],
-                             16: [(80, "P80", "Low pressuree protection set point", 0.01, 0),
-                                  (81, "P81", "High pressure protection release hysteresis", 0.01, 0),
-                                  (82, "P82", "Low pressure protection release hysteresis", 0.01, 0),
-                                  (83, "P83", "Electric heating control mode", 0, 0)],
-                                  # 84 not used
-                             17: [(85, "P84", "Reporting frequency", 0, 0),
-                                  (86, "P85", "Reset", 0, 0),
-#                                  (87, "P86", "User password setting", 0, 0),
-#                                  (88, "P87", "Administrator password setting", 0, 0),
-                                  (89, "P88", "Chassis heating start ambient temperature", 1, 0)],
-                             18: [(90, "P89", "hot water coil", 0, 0)],
-                                 }
+        self.change_detection = "hash"
+        self.readout_dict = self.plan.blocks(self.type)
 
 class MeasValuesReader(ReaderBase):
-    def __init__(self, client):
-        super().__init__(client, "MeasValues")
+    def __init__(self, client, max_gap=8, max_count=MAX_READ_COUNT, unit=1, plan=None):
+        super().__init__(client, "MeasValues", max_gap, max_count, unit, plan)
         self.data_filename = "MeasValues.csv"
-        self.readout_dict = {40: [(200, "C00", "External coil temperature", 0.5, 0), 
-                                  (201, "C01", "Exhaust gas temperature", 0.5, 0), 
-                                  (202, "C02", "Ambient temperature", 0.5, 0), 
-                                  (203, "C03", "Return gas temperature", 0.5, 0), 
-                                  (204, "C04", "EVI inlet temperature", 0.5, 0)],
-                             41: [(205, "C05", "EVI outlet temperature", 0.5, 0), 
-                                  (206, "C06", "Internal coil temperature", 0.5, 0), 
-                                  (207, "C07", "Inlet temperature", 0.5, 0),
-                                  (208, "C08", "water temperature", 0.5, 0), 
-                                  (209, "C09", "domestic hot water temperature", 0.5, 0)],
-                             42: [(210, "C10", "hot water pipe temperature", 0.5, 0), 
-                                  (211, "C11", "Room temperature", 0.5, 0), 
-                                  (212, "C12", "Solar temperature", 0.5, 0), 
-                                  (213, "C13", "Outer water flow rate", 0, 0), 
-                                  (214, "C14", "Inner water flow rate", 0, 0) ],
-                             43: [(215, "C15", "Actual overheat degree of main expansion valve", 0.5, 0), 
-                                  (216, "C16", "Actual overheat degree of injection enthalpy valve", 0.5, 0), 
-                                  (217, "C17", "high pressure", 0,1, 0), 
-                                  (218, "C18", "low pressure", 0.1, 0), 
-                                  (219, "C19", "High pressure switch status", 0, 0)],
-                             44: [(220, "C20", "Low pressure switch status", 0, 0),
-                                  (221, "C21", "Temperature control switch status", 0, 0),
-                                  (222, "C22", "Internal water flow switch status", 0, 0),
-                                  (223, "C23", "Outer water flow switch status", 0, 0),
-                                  (224, "C24", "Cooling switch status", 0, 0)],
-                             45: [(225, "C25", "Heating switch status", 0, 0),
-                                  (226, "C26", "Phase sequence state", 0, 0),
-                                  (227, "C27", "defrost state", 0, 0),
-                                  (228, "C28", "Sterilize state", 0, 0),
-                                  (229, "C29", "Antifreeze state", 0, 0)],
-                             46: [(230, "C30", "compressor", 0, 0),
-                                  (231, "C31", "outdoor fan1", 0, 0),
-                                  (232, "C32", "outdoor fan2", 0, 0),
-                                  (233, "C33", "water pump1 state", 0, 0),
-                                  (234, "C34", "water pump2 state", 0, 0)],
-                             47: [(235, "C35", "water pump3 state", 0, 0),
-                                  (236, "C36", "water pump4 state", 0, 0),
-                                  (237, "C37", "water pump5 state", 0, 0),
-                                  (238, "C38", "bypass valve", 0, 0),
-                                  (239, "C39", "EVI electromagnetic valve", 0, 0)],
-                             48: [(240, "C40", "Four-way valve status", 0, 0),
-                                  (241, "C41", "Air conditioner electric heating status", 0, 0),
-                                  (242, "C42", "Domestic hot water electric heating status", 0, 0),
-                                  (243, "C43", "Crankshaft heater status", 0, 0),
-                                  (244, "C44", "Three-way valve 1 state", 0, 0)],
-                             49: [(245, "C45", "Three-way valve 2 state", 0, 0),
-                                  (246, "C46", "Three-way valve 3 state", 0, 0),
-                                  (247, "C47", "Main expansion valve opening", 0, 0),
-                                  (248, "C48", "Enthalpy injection expansion valve opening", 0, 0),
-                                  (249, "C49", "Compressor start and stop times", 0, 0)],
-                             50: [(250, "C50", "Compressor running time", 0, 0),
-                                  (251, "C51", "Current working mode", 0, 0),
-                                  (252, "C52", "Total defrosting times", 0, 0),
-                                  (253, "C53", "Compressor target frequency", 0, 0),
-                                  (254, "C54", "Compressor input current", 0.1, 0)],
-                             51: [(255, "C55", "Outdoor unit module temp.", 0.5, 0),
-                                  (256, "C56", "Inverter running code1", 0, 0),
-                                  (257, "C57", "Inverter running code2", 0, 0),
-                                  (258, "C58", "Inverter running code3", 0, 0),
-                                  (259, "C59", "Compressor Error Codes", 0, 0)],
-                             52: [(260, "C60", "IPM fan", 0, 0),
-                                  (261, "C61", "Tc", 0, 0),
-                                  (262, "C62", "Ts", 0, 0),
-                                  (263, "C63", "P", 0, 0),
-                                  (264, "C64", "Main board program version", 0, 0)],
-                             53: [(265, "C65", "Driver module program version", 0, 0),
-                                  (266, "C66", "Chassis Electric Heating Status", 0, 0)]
-                            }
+        self.readout_dict = self.plan.blocks(self.type)
+
+# meas values besides the scaled temperatures, pressures and currents that change quickly
+FAST_MEAS_VALUES = ("C13", "C14", "C30", "C31", "C32", "C47", "C48", "C53")
+
+def createClient(com_port):
+    return ModbusClient(method='rtu', port=com_port, baudrate=9600, parity='N', timeout=0.1)
 
 class ReaderMain():
-    def __init__(self, output_path=os.getcwd(), com_port="COM2"):
+    def __init__(self, output_path=os.getcwd(), com_port="COM2", max_gap=8, max_count=MAX_READ_COUNT, map_path=DEFAULT_SOURCE,
+                 snapshots=None, pipeline=None, metrics=None):
         self.output_path = output_path 
+        self.metrics = metrics
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self.plan = loadRegisterPlan(map_path)
         try:
             logger.info(f"connect to NuLite heatpump via com port {com_port}")
-            self.client = ModbusClient(method='rtu', port=com_port, baudrate=9600, parity='N', timeout=0.1)
+            self.client = createClient(com_port)
             self.connection = self.client.connect()
         except Exception as _e:
             logger.error(f"{_e}")
-        self.workers = [ParameterReader(self.client), MeasValuesReader(self.client)]
+        self.workers = [ParameterReader(self.client, max_gap, max_count, plan=self.plan), MeasValuesReader(self.client, max_gap, max_count, plan=self.plan)]
+        for item in self.workers:
+            item.snapshots = snapshots
+            item.pipeline = pipeline
+            item.metrics = metrics
+        deviceTransport(self.client).metrics = metrics
 
     def Process(self):
         logger.info("start reading data")
         for item in self.workers:
             item.read()
             #print(item.data)
-            item.writeDataToFile(self.output_path)
+            item.persist(self.output_path)
         
         logger.info("reading finished")
 
+    def Run(self, fast_interval=5, status_interval=30, parameter_interval=300, stats_interval=60):
+        # keep the client open and read every register group at its own rate
+        parameters, meas_values = self.workers
+        fast = [parameter[1] for parameter in meas_values.registers
+                if parameter[3] != 0 or parameter[1] in FAST_MEAS_VALUES]
+        status = [parameter[1] for parameter in meas_values.registers if parameter[1] not in fast]
+        groups = [ScanGroup(meas_values.select("MeasValuesFast", fast), fast_interval),
+                  ScanGroup(meas_values.select("MeasValuesStatus", status), status_interval),
+                  ScanGroup(parameters, parameter_interval)]
+        scheduler = Scheduler(self.client, groups, self.output_path, max_gap=self.max_gap,
+                              max_count=self.max_count, stats_interval=stats_interval, metrics=self.metrics)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: scheduler.request(parameters.type))
+        signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+        logger.info(f"start polling, fast {fast_interval}s, status {status_interval}s, parameters {parameter_interval}s")
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            scheduler.logStats()
+        finally:
+            self.client.close()
+        logger.info("polling stopped")
+
+    def Serve(self, http_port=None, socket_path=None, fast_interval=5, status_interval=30, parameter_interval=300):
+        # the only process on the bus, other programs query the cached values over http or a unix socket
+        parameters, meas_values = self.workers
+        ttls = {parameter[1]: parameter_interval for parameter in parameters.registers}
+        for parameter in meas_values.registers:
+            fast = parameter[3] != 0 or parameter[1] in FAST_MEAS_VALUES
+            ttls[parameter[1]] = fast_interval if fast else status_interval
+        cache = RegisterCache(self.client, self.plan, ttls, fast_interval, max_gap=self.max_gap, max_count=self.max_count)
+        server = CacheServer(cache, http_port, socket_path).start()
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+        try:
+            while not stopped.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+            self.client.close()
+        logger.info("serving stopped")
+
+class FleetMain():
+    def __init__(self, targets, output_path=os.getcwd(), max_gap=8, max_count=MAX_READ_COUNT, client_factory=None,
+                 map_path=DEFAULT_SOURCE, snapshots=None, pipeline=None, metrics=None):
+        # one serialized bus per port, all ports polled concurrently
+        self.output_path = output_path
+        self.snapshots = snapshots
+        self.pipeline = pipeline
+        self.metrics = metrics
+        self.plan = loadRegisterPlan(map_path)
+        self.targets = targets
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self.engine = PollingEngine(targets, client_factory or self.connect,
+                                    [self.createReader(ParameterReader), self.createReader(MeasValuesReader)],
+                                    self.writeResult)
+        for worker in self.engine.workers:
+            for target in worker.targets:
+                deviceTransport(worker.client, target.unit).metrics = metrics
+
+    def connect(self, com_port):
+        logger.info(f"connect to NuLite heatpumps via com port {com_port}")
+        client = createClient(com_port)
+        if not client.connect():
+            logger.error(f"could not open com port {com_port}")
+        return client
+
+    def createReader(self, reader_class):
+        def factory(client, target):
+            reader = reader_class(client, self.max_gap, self.max_count, target.unit, self.plan)
+            reader.data_filename = f"{target.tag}_{reader.data_filename}"
+            reader.snapshots = self.snapshots
+            reader.pipeline = self.pipeline
+            reader.metrics = self.metrics
+            return reader
+        return factory
+
+    def writeResult(self, result):
+        if result.error is None:
+            logger.info(f"{result.target!r} scan report {result.report}")
+            result.reader.persist(self.output_path)
+
+    def Process(self, cycles=1, interval=0):
+        logger.info(f"start polling {len(self.targets)} heatpumps")
+        try:
+            asyncio.run(self.engine.run(cycles, interval))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.engine.close()
+        logger.info("polling finished")
+
+class ApplyMain():
+    def __init__(self, targets, max_count=WRITE_MAX_COUNT, map_path=DEFAULT_SOURCE, client_factory=createClient):
+        # the ports are written concurrently, the units of a port one after the other
+        self.targets = targets
+        self.max_count = max_count
+        self.plan = loadRegisterPlan(map_path)
+        self.client_factory = client_factory
+
+    def applyPort(self, port, targets, desired, current, dry_run):
+        client = self.client_factory(port)
+        client.connect()
+        reports = []
+        try:
+            for target in targets:
+                writer = ParameterWriter(ParameterReader(client, unit=target.unit, plan=self.plan), self.max_count)
+                report = writer.apply(desired, current, dry_run)
+                logger.info(f"{target!r} {report}")
+                reports.append(report)
+        finally:
+            client.close()
+        return reports
+
+    def Process(self, desired_path, snapshot_path=None, dry_run=False):
+        desired = loadDesired(desired_path)
+        current = loadSnapshot(snapshot_path) if snapshot_path is not None else None
+        ports = {}
+        for target in self.targets:
+            ports.setdefault(target.port, []).append(target)
+        with ThreadPoolExecutor(max_workers=len(ports) or 1) as executor:
+            futures = [executor.submit(self.applyPort, port, targets, desired, current, dry_run) for port, targets in ports.items()]
+            reports = [report for future in futures for report in future.result()]
+        return all(not report.rejected and not report.mismatches for report in reports)
+
 def main():
     parser = argparse.ArgumentParser(
         description="Read out all the Parameters and meas values via modus RTU, of NuLite Flamingo HeatPump"
@@ -334,14 +451,238 @@ def main():
         type=str,
         help="Serial Com port that should be used"
     )
+    parser.add_argument(
+        "-g",
+        "--gap",
+        dest="gap",
+        default=8,
+        type=int,
+        help="Number of unused registers that may be bridged within one modbus request"
+    )
+    parser.add_argument(
+        "-m",
+        "--max-count",
+        dest="max_count",
+        default=MAX_READ_COUNT,
+        type=int,
+        help=f"Maximum number of registers per modbus request (at most {MAX_READ_COUNT}), halved automatically while the heatpump rejects the size of a request"
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        action="store_true",
+        help="Append the scans to the binary time series store in <output>/store instead of writing a csv per scan, short for --sinks store"
+    )
+    parser.add_argument(
+        "--serve-http",
+        dest="serve_http",
+        type=int,
+        help="Serve the cached register values on this localhost http port instead of writing scans, ttl per group from --fast / --status / --params"
+    )
+    parser.add_argument(
+        "--serve-socket",
+        dest="serve_socket",
+        type=str,
+        help="Serve the cached register values on this unix socket (one query per line)"
+    )
+    parser.add_argument(
+        "--apply",
+        dest="apply",
+        type=str,
+        help="Write the parameters of this file (json name -> value, or a Parameters csv) to the heatpumps of -c / -t, only the changed ones"
+    )
+    parser.add_argument(
+        "--snapshot",
+        dest="snapshot",
+        type=str,
+        help="Apply: Parameters csv of an earlier readout used as the current state instead of reading the parameters first"
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Apply: only log the writes"
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        type=int,
+        help="Serve prometheus metrics (request latency, bus errors, scan and stage times) on this localhost http port"
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        type=str,
+        help="Run under cProfile, including the bus and writer threads, and dump the stats to this file when the readout ends (python -m pstats FILE)"
+    )
+    parser.add_argument(
+        "--sinks",
+        dest="sinks",
+        type=str,
+        help="Comma separated sinks written by a background thread: csv, jsonl, sqlite, store, mqtt (default csv, store with --store)"
+    )
+    parser.add_argument(
+        "--queue",
+        dest="queue",
+        default=64,
+        type=int,
+        help="Number of scans the writer queue holds before the backpressure policy applies"
+    )
+    parser.add_argument(
+        "--backpressure",
+        dest="backpressure",
+        default=DROP_OLDEST,
+        choices=POLICIES,
+        help="What happens to a scan when the writer queue is full (default drop-oldest, polling never waits)"
+    )
+    parser.add_argument(
+        "--mqtt",
+        dest="mqtt",
+        type=str,
+        help="host[:port] of the mqtt broker, required by the mqtt sink (needs paho-mqtt)"
+    )
+    parser.add_argument(
+        "--changes",
+        dest="changes",
+        action="store_true",
+        help="Only persist the values that changed since the last persisted scan, plus periodic keyframes"
+    )
+    parser.add_argument(
+        "--deadband",
+        dest="deadband",
+        type=str,
+        help="Changes: comma separated deadbands per register e.g. C02=1.0,C17=0.2, a value is persisted once it differs by more than its deadband (default 0.5 for the temperatures, exact otherwise)"
+    )
+    parser.add_argument(
+        "--keyframe",
+        dest="keyframe",
+        default=3600,
+        type=float,
+        help="Changes: interval in seconds between scans that are persisted in full"
+    )
+    parser.add_argument(
+        "--map",
+        dest="map",
+        default=DEFAULT_SOURCE,
+        type=str,
+        help="Register map, the vendor spreadsheet (.xlsx) or an export of it (.json / .csv)"
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Log every modbus request and register value"
+    )
+    parser.add_argument(
+        "-t",
+        "--targets",
+        dest="targets",
+        type=str,
+        help="Comma separated list of port:unit targets e.g. COM2:1,COM2:2,COM3:1, polls several heatpumps instead of -c"
+    )
+    parser.add_argument(
+        "--interval",
+        dest="interval",
+        default=60,
+        type=float,
+        help="Daemon with targets: interval in seconds between poll cycles over all heatpumps"
+    )
+    parser.add_argument(
+        "--daemon",
+        dest="daemon",
+        action="store_true",
+        help="Keep the connection open and poll the register groups continuously"
+    )
+    parser.add_argument(
+        "--fast",
+        dest="fast",
+        default=5,
+        type=float,
+        help="Daemon: interval in seconds for temperatures, pressures and currents"
+    )
+    parser.add_argument(
+        "--status",
+        dest="status",
+        default=30,
+        type=float,
+        help="Daemon: interval in seconds for the switch and status values"
+    )
+    parser.add_argument(
+        "--params",
+        dest="params",
+        default=300,
+        type=float,
+        help="Daemon: interval in seconds for the parameters, 0 reads them only at start and on SIGUSR1"
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        default=60,
+        type=float,
+        help="Daemon: interval in seconds for logging scan jitter and overrun statistics"
+    )
 
     # Parse the command-line arguments
     args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
     
+    if args.apply is not None:
+        targets = [Target.parse(item) for item in (args.targets or args.com).split(",") if item.strip()]
+        try:
+            succeeded = ApplyMain(targets, map_path=args.map).Process(args.apply, args.snapshot, args.dry_run)
+        except (OSError, ValueError, RegisterMapError) as _e:
+            logger.error(f"could not apply {args.apply} {_e}")
+            succeeded = False
+        sys.exit(0 if succeeded else 1)
+
     if args.output is not None and os.path.isdir(args.output):
-        if args.com is not None:
-            MyReaderMain = ReaderMain(args.output, args.com)
-            MyReaderMain.Process()
+        try:
+            loadRegisterPlan(args.map)
+        except (OSError, RegisterMapError) as _e:
+            logger.error(f"could not load the register map {_e}")
+            sys.exit(1)
+        sinks = args.sinks if args.sinks is not None else ("store" if args.store else "csv")
+        # the time series store is written by its sink only
+        store = TimeSeriesStore(os.path.join(args.output, "store")) if "store" in sinks else None
+        snapshots = None
+        if args.changes:
+            snapshots = SnapshotCache(os.path.join(args.output, ".snapshots.json"), args.keyframe, parseDeadbands(args.deadband))
+        # started before the writer and bus threads, so they are profiled as well
+        profile = ThreadProfiler().start() if args.profile is not None else None
+        try:
+            pipeline = WriterPipeline(createSinks(sinks, args.output, store, args.mqtt), args.queue, args.backpressure)
+        except (ValueError, RuntimeError, OSError) as _e:
+            logger.error(f"could not create the sinks {_e}")
+            sys.exit(1)
+        metrics = Metrics() if args.metrics is not None else None
+        metrics_server = MetricsServer(metrics, args.metrics).start() if metrics is not None else None
+        pipeline.metrics = metrics
+        try:
+            if args.targets is not None:
+                targets = [Target.parse(item) for item in args.targets.split(",") if item.strip()]
+                MyFleetMain = FleetMain(targets, args.output, args.gap, args.max_count, map_path=args.map,
+                                        snapshots=snapshots, pipeline=pipeline, metrics=metrics)
+                if args.daemon:
+                    MyFleetMain.Process(0, args.interval)
+                else:
+                    MyFleetMain.Process()
+            elif args.com is not None:
+                MyReaderMain = ReaderMain(args.output, args.com, args.gap, args.max_count, args.map, snapshots, pipeline, metrics)
+                if args.serve_http is not None or args.serve_socket is not None:
+                    MyReaderMain.Serve(args.serve_http, args.serve_socket, args.fast, args.status, args.params)
+                elif args.daemon:
+                    MyReaderMain.Run(args.fast, args.status, args.params, args.stats)
+                else:
+                    MyReaderMain.Process()
+        finally:
+            # the queued scans are written before the process ends
+            pipeline.close()
+            if profile is not None:
+                profile.stop(args.profile)
+            if metrics_server is not None:
+                metrics_server.stop()
     else:
         logger.error(f"output folder {args.output} does not exist")
 
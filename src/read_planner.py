@@ -0,0 +1,166 @@
+import logging
+from array import array
+
+logger = logging.getLogger('Modbus')
+
+# Modbus limits for function code 0x03 (read holding registers)
+MAX_READ_COUNT = 125
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+
+READ_HOLDING_REGISTERS = 0x03
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+# RTU frame sizes: slave id + function code + payload + 2 byte crc;
+# a 0x06 request and its echo have the size of a read request
+REQUEST_FRAME_BYTES = 8
+RESPONSE_FRAME_BYTES = 5
+EXCEPTION_FRAME_BYTES = 5
+WRITE_REQUEST_FRAME_BYTES = 9
+WRITE_RESPONSE_FRAME_BYTES = 8
+
+
+class ReadRequest():
+    def __init__(self, parameters):
+        # parameters are register tuples (address, name, description, scale, offset), sorted by address
+        self.parameters = parameters
+        self.start = parameters[0][0]
+        self.count = parameters[-1][0] - self.start + 1
+
+    def __repr__(self):
+        return f"ReadRequest(start={self.start}, count={self.count}, registers={len(self.parameters)})"
+
+
+class ScanReport():
+    def __init__(self, type):
+        self.type = type
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.splits = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.crc_errors = 0
+        self.exceptions = 0
+        self.failed = 0
+        self.missing = 0
+
+    def addRequest(self, count, response, function=READ_HOLDING_REGISTERS):
+        self.requests += 1
+        write = function != READ_HOLDING_REGISTERS
+        self.bytes_sent += WRITE_REQUEST_FRAME_BYTES + 2 * count if function == WRITE_MULTIPLE_REGISTERS else REQUEST_FRAME_BYTES
+        if response is None:
+            return
+        if response.isError():
+            # an IO error means nothing usable came back from the slave
+            if hasattr(response, "exception_code"):
+                self.bytes_received += EXCEPTION_FRAME_BYTES
+        else:
+            self.bytes_received += WRITE_RESPONSE_FRAME_BYTES if write else RESPONSE_FRAME_BYTES + 2 * count
+
+    def __str__(self):
+        return (f"{self.type}: {self.requests} requests, {self.bytes_sent} bytes sent, "
+                f"{self.bytes_received} bytes received, {self.splits} splits, {self.retries} retries, "
+                f"{self.timeouts} timeouts, {self.crc_errors} crc errors, {self.exceptions} exception responses, {self.failed} failed requests, "
+                f"{self.missing} registers missing")
+
+
+class RegisterImage():
+    # raw uint16 register values indexed by address, filled with one slice assignment per response
+    def __init__(self, size):
+        self.registers = array('H', bytes(2 * size))
+        self.valid = bytearray(size)
+
+    def store(self, start, registers):
+        count = len(registers)
+        self.registers[start:start + count] = array('H', registers)
+        self.valid[start:start + count] = b'\x01' * count
+
+    def __contains__(self, address):
+        return address < len(self.valid) and self.valid[address] == 1
+
+    def __getitem__(self, address):
+        return self.registers[address]
+
+
+class ReadPlanner():
+    def __init__(self, parameters, max_gap=8, max_count=MAX_READ_COUNT):
+        self.max_gap = max_gap
+        self.max_count = min(max_count, MAX_READ_COUNT)
+        self.requests = self.build(parameters)
+        self.size = self.requests[-1].start + self.requests[-1].count if self.requests else 0
+
+    def build(self, parameters):
+        # merge the register addresses into the fewest contiguous requests, bridging holes up to max_gap
+        requests = []
+        current = []
+        for parameter in sorted(parameters, key=lambda parameter: parameter[0]):
+            if current:
+                gap = parameter[0] - current[-1][0] - 1
+                span = parameter[0] - current[0][0] + 1
+                if gap > self.max_gap or span > self.max_count:
+                    requests.append(ReadRequest(current))
+                    current = []
+            current.append(parameter)
+        if current:
+            requests.append(ReadRequest(current))
+        return requests
+
+    def split(self, request):
+        # bisect at the widest hole, or in the middle if the request has none
+        parameters = request.parameters
+        gaps = [parameters[i + 1][0] - parameters[i][0] for i in range(len(parameters) - 1)]
+        widest = max(gaps)
+        cut = gaps.index(widest) + 1 if widest > 1 else len(parameters) // 2
+        halves = [ReadRequest(parameters[:cut]), ReadRequest(parameters[cut:])]
+        index = self.requests.index(request)
+        self.requests[index:index + 1] = halves
+        return halves
+
+    def drop(self, request):
+        self.requests.remove(request)
+
+    def shrink(self, pending):
+        # re-plan the requests that exceed a lowered max_count, in the plan and in the pending requests of the scan
+        for request in [request for request in pending if request.count > self.max_count]:
+            pieces = self.build(request.parameters)
+            index = self.requests.index(request)
+            self.requests[index:index + 1] = pieces
+            index = pending.index(request)
+            pending[index:index + 1] = pieces
+
+    def execute(self, transport, report):
+        # returns the RegisterImage with the raw values of all readable registers,
+        # registers of requests that still fail after the transport retries stay invalid
+        values = RegisterImage(self.size)
+        pending = list(self.requests)
+        while pending:
+            request = pending.pop(0)
+            logger.debug(f"read start_address {request.start}, number of words {request.count}")
+            read_vals = transport.read(request.start, request.count, report)
+            if read_vals is None or read_vals.isError():
+                exception_code = getattr(read_vals, "exception_code", None)
+                if exception_code == ILLEGAL_DATA_VALUE and request.count > 1:
+                    # the device reads fewer registers per request (the vendor sheet says 8), later scans keep the limit
+                    self.max_count = min(self.max_count, request.count // 2)
+                    logger.warning(f"device rejected the size of {request}, reading at most {self.max_count} registers per request")
+                    report.splits += 1
+                    pending.insert(0, request)
+                    self.shrink(pending)
+                    continue
+                if exception_code != ILLEGAL_DATA_ADDRESS:
+                    logger.warning(f"{report.type}: {request} failed ({read_vals}), its registers are missing in this scan")
+                    report.failed += 1
+                    continue
+                if len(request.parameters) > 1:
+                    logger.warning(f"device rejected {request}, splitting it")
+                    report.splits += 1
+                    pending[0:0] = self.split(request)
+                else:
+                    logger.error(f"device rejected register {request.start}, removing it from the plan")
+                    self.drop(request)
+                continue
+            values.store(request.start, read_vals.registers)
+        return values
@@ -0,0 +1,346 @@
+import os
+import re
+import sys
+import csv
+import json
+import math
+import pickle
+import struct
+import hashlib
+import logging
+import argparse
+import zipfile
+import xml.etree.ElementTree as ET
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger('Modbus')
+
+
+class CompiledRegisterMap():
+    # the register tuples (address, name, description, scale, offset) compiled into columns,
+    # scale 0 marks a raw unsigned integer, everything else is a scaled signed 16 bit value
+    def __init__(self, registers):
+        self.names = [parameter[1] for parameter in registers]
+        self.descriptions = [parameter[2] for parameter in registers]
+        self.addresses = array('H', [parameter[0] for parameter in registers])
+        self.signed = array('b', [parameter[3] != 0 for parameter in registers])
+        self.scales = array('d', [parameter[3] if parameter[3] != 0 else 1 for parameter in registers])
+        self.offsets = array('d', [parameter[4] if parameter[3] != 0 else 0 for parameter in registers])
+        if np is not None:
+            self.np_addresses = np.array(self.addresses, dtype=np.intp)
+            self.np_signed = np.array(self.signed, dtype=bool)
+            self.np_scales = np.array(self.scales, dtype=np.float64)
+            self.np_offsets = np.array(self.offsets, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def decode(self, image):
+        # returns the raw, value and valid columns for a RegisterImage in one batched operation
+        if len(self.addresses) == 0:
+            return array('H'), [], []
+        if np is not None:
+            raw, values = self.decodeColumns(np.frombuffer(image.registers, dtype=np.uint16)[self.np_addresses])
+            valid = np.frombuffer(image.valid, dtype=np.uint8)[self.np_addresses].astype(bool)
+            return raw, values, valid
+        raw, values = self.decodeColumns(array('H', [image.registers[address] for address in self.addresses]))
+        valid = [image.valid[address] == 1 for address in self.addresses]
+        return raw, values, valid
+
+    def decodeColumns(self, raw):
+        # raw and value columns of register values that are already gathered in map order, e.g. a stored record
+        if np is not None:
+            raw = np.asarray(raw, dtype=np.uint16)
+            return raw, np.where(self.np_signed, (raw.view(np.int16) + self.np_offsets) * self.np_scales, raw)
+        if not isinstance(raw, array):
+            raw = array('H', raw)
+        signed_values = struct.unpack(f'{len(raw)}h', raw.tobytes())
+        values = [(signed_value + offset) * scale if signed else raw_value
+                  for raw_value, signed_value, signed, scale, offset
+                  in zip(raw, signed_values, self.signed, self.scales, self.offsets)]
+        return raw, values
+
+    def formatRows(self, raw, values, valid, indices=None):
+        # formatting is left to the sinks, registers that could not be read have an empty value
+        rows = []
+        for index in (range(len(self.addresses)) if indices is None else indices):
+            if not valid[index]:
+                rows.append(f"{self.names[index]}, , {self.descriptions[index]}, {self.addresses[index]}, ")
+                continue
+            if self.signed[index]:
+                value = f"{float(values[index]):.2f}"
+            else:
+                value = int(raw[index])
+            rows.append(f"{self.names[index]}, {value}, {self.descriptions[index]}, {self.addresses[index]}, {int(raw[index])}")
+        return rows
+
+
+PLAN_VERSION = 1
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docu",
+                              "Flamingo_RS485_2024_06_03_19_38_53.xlsx")
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nulite-rtu-modbus-readout")
+
+# register name prefix -> reader type
+GROUPS = {"P": "Parameters", "C": "MeasValues"}
+
+# the password registers are never read out
+EXCLUDED_REGISTERS = ("P86", "P87")
+
+# known typos of the vendor spreadsheet
+ERRATA = {"C15": {"description": "Actual overheat degree of main expansion valve"}}
+
+REGISTER_FIELDS = ("address", "name", "description", "scale", "offset")
+RANGE_FIELDS = ("minimum", "maximum")
+
+XLSX_NAMESPACE = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NAME_PATTERN = re.compile(r"^([PC]\d+)\s*[（(]\s*(\d+)\s*[)）]$")
+RANGE_PATTERN = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*[~-]\s*(-?\d+(?:\.\d+)?)")
+NUMBER_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)")
+TEMPERATURE_UNITS = ("℃", "°C", "ºC")
+
+
+class RegisterMapError(ValueError):
+    pass
+
+
+class RegisterPlan():
+    def __init__(self, groups, ranges, source_hash=""):
+        # groups: reader type -> register tuples (address, name, description, scale, offset)
+        # ranges: register name -> (minimum, maximum) of the adjustment range
+        self.groups = groups
+        self.ranges = ranges
+        self.source_hash = source_hash
+
+    def blocks(self, type):
+        # the register tuples of a reader keyed by their 5 register block, the layout of readout_dict
+        blocks = {}
+        for parameter in self.groups.get(type, []):
+            blocks.setdefault(parameter[0] // 5, []).append(parameter)
+        return blocks
+
+    def registers(self):
+        return [parameter for group in self.groups.values() for parameter in group]
+
+
+def validateRows(rows):
+    # rows are (group, register tuple, range) as read from a source, returns the RegisterPlan
+    errors = []
+    groups = {}
+    ranges = {}
+    addresses = {}
+    names = set()
+    for group, parameter, limits in rows:
+        if len(parameter) != len(REGISTER_FIELDS):
+            errors.append(f"{parameter}: expected {len(REGISTER_FIELDS)} fields {REGISTER_FIELDS}, got {len(parameter)}")
+            continue
+        address, name, description, scale, offset = parameter
+        if not isinstance(address, int) or not 0 <= address <= 0xFFFF:
+            errors.append(f"{name}: invalid register address {address!r}")
+            continue
+        if name in names:
+            errors.append(f"{name}: duplicate register name")
+        names.add(name)
+        if address in addresses:
+            errors.append(f"{name}: register {address} is already used by {addresses[address]}")
+        addresses[address] = name
+        if not isinstance(scale, (int, float)) or not math.isfinite(scale) or scale < 0 or scale > 100:
+            errors.append(f"{name}: implausible scale {scale!r}")
+        elif scale == 0 and offset != 0:
+            errors.append(f"{name}: offset {offset} is ignored for a raw register (scale 0), is the scale a typo?")
+        if limits is not None:
+            if limits[0] > limits[1]:
+                errors.append(f"{name}: range minimum {limits[0]} above maximum {limits[1]}")
+            ranges[name] = limits
+        groups.setdefault(group, []).append((address, name, description, scale, offset))
+
+    # the address ranges of the readers must not interleave
+    spans = sorted((min(p[0] for p in group), max(p[0] for p in group), type) for type, group in groups.items())
+    for first, second in zip(spans, spans[1:]):
+        if second[0] <= first[1]:
+            errors.append(f"register groups {first[2]} ({first[0]}-{first[1]}) and {second[2]} ({second[0]}-{second[1]}) overlap")
+
+    if errors:
+        raise RegisterMapError("invalid register map:\n  " + "\n  ".join(errors))
+    for group in groups.values():
+        group.sort(key=lambda parameter: parameter[0])
+    return RegisterPlan(groups, ranges)
+
+
+def readXlsxRows(path):
+    # minimal reader for the first worksheet of the vendor spreadsheet, returns the cell texts per row
+    with zipfile.ZipFile(path) as archive:
+        strings = []
+        if "xl/sharedStrings.xml" in archive.namelist():
+            root = ET.fromstring(archive.read("xl/sharedStrings.xml"))
+            for item in root.iter(f"{XLSX_NAMESPACE}si"):
+                strings.append("".join(text.text or "" for text in item.iter(f"{XLSX_NAMESPACE}t")))
+        root = ET.fromstring(archive.read("xl/worksheets/sheet1.xml"))
+    rows = []
+    for row in root.iter(f"{XLSX_NAMESPACE}row"):
+        cells = {}
+        for cell in row.iter(f"{XLSX_NAMESPACE}c"):
+            value = cell.find(f"{XLSX_NAMESPACE}v")
+            if value is None:
+                continue
+            column = re.sub(r"\d", "", cell.get("r"))
+            cells[column] = strings[int(value.text)] if cell.get("t") == "s" else value.text
+        rows.append(cells)
+    return rows
+
+
+def parseRange(text):
+    match = RANGE_PATTERN.match(text)
+    if match is None:
+        return None
+    return (float(match.group(1)), float(match.group(2)))
+
+
+def loadXlsx(path):
+    rows = []
+    for cells in readXlsxRows(path):
+        match = NAME_PATTERN.match(cells.get("A", "").strip())
+        if match is None:
+            continue
+        name, address = match.group(1), int(match.group(2))
+        if name in EXCLUDED_REGISTERS or name[0] not in GROUPS:
+            continue
+        description = " ".join(cells.get("B", "").split())
+        description = ERRATA.get(name, {}).get("description", description)
+        scope = cells.get("C", "")
+        accuracy = NUMBER_PATTERN.match(cells.get("E", ""))
+        if accuracy is None:
+            raise RegisterMapError(f"{name}: no data accuracy in {path}")
+        scale = float(accuracy.group(1))
+        limits = parseRange(scope)
+        if scale == 1 and not (any(unit in scope for unit in TEMPERATURE_UNITS) or (limits is not None and limits[0] < 0)):
+            # plain counters, codes and switch states are reported as raw integers
+            scale = 0.0
+        scale = int(scale) if scale.is_integer() else scale
+        rows.append((GROUPS[name[0]], (address, name, description, scale, 0), limits))
+    return rows
+
+
+def loadJson(path):
+    # {"Parameters": [{"address": 0, "name": "P00", ...}, ...], ...} or lists in REGISTER_FIELDS order
+    with open(path, encoding="utf-8") as fp:
+        content = json.load(fp)
+    rows = []
+    for group, registers in content.items():
+        for register in registers:
+            if isinstance(register, dict):
+                parameter = tuple(register[field] for field in REGISTER_FIELDS if field in register)
+                limits = (register["minimum"], register["maximum"]) if "minimum" in register and "maximum" in register else None
+            else:
+                parameter = tuple(register)
+                limits = None
+            rows.append((group, parameter, limits))
+    return rows
+
+
+def loadCsv(path):
+    # columns: group, address, name, description, scale, offset[, minimum, maximum]
+    rows = []
+    with open(path, newline="", encoding="utf-8") as fp:
+        for line in csv.reader(fp):
+            if not line or line[0].strip() in ("", "group") or line[0].startswith("#"):
+                continue
+            values = [value.strip() for value in line]
+            try:
+                parameter = (int(values[1]), values[2], values[3], float(values[4]), float(values[5])) + tuple(values[8:])
+                limits = (float(values[6]), float(values[7])) if len(values) > 7 and values[6] and values[7] else None
+            except (IndexError, ValueError) as _e:
+                raise RegisterMapError(f"{path}: invalid row {line}: {_e}")
+            parameter = tuple(int(value) if isinstance(value, float) and value.is_integer() else value for value in parameter)
+            rows.append((values[0], parameter, limits))
+    return rows
+
+
+LOADERS = {".xlsx": loadXlsx, ".json": loadJson, ".csv": loadCsv}
+
+_plans = {}
+
+
+def loadRegisterPlan(path=DEFAULT_SOURCE, cache_dir=DEFAULT_CACHE_DIR):
+    # the validated plan is cached on disk keyed by the hash of the source file, so startups skip the parsing
+    path = os.path.abspath(path)
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in LOADERS:
+        raise RegisterMapError(f"unsupported register map format {path}, use one of {', '.join(LOADERS)}")
+    with open(path, "rb") as fp:
+        source_hash = hashlib.sha256(fp.read()).hexdigest()
+    if source_hash in _plans:
+        return _plans[source_hash]
+
+    cache_file = os.path.join(cache_dir, f"register_plan_{PLAN_VERSION}_{source_hash[:32]}.pickle") if cache_dir else None
+    if cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "rb") as fp:
+                groups, ranges = pickle.load(fp)
+            plan = RegisterPlan(groups, ranges, source_hash)
+            logger.debug(f"register map loaded from cache {cache_file}")
+        except Exception as _e:
+            logger.warning(f"could not use the register map cache {cache_file}: {_e}")
+        else:
+            _plans[source_hash] = plan
+            return plan
+
+    plan = validateRows(LOADERS[extension](path))
+    plan.source_hash = source_hash
+    logger.info(f"register map compiled from {path}: " + ", ".join(f"{len(group)} {type}" for type, group in plan.groups.items()))
+    if cache_file is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file + ".tmp", "wb") as fp:
+                pickle.dump((plan.groups, plan.ranges), fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_file + ".tmp", cache_file)
+        except OSError as _e:
+            logger.warning(f"could not write the register map cache {cache_file}: {_e}")
+    _plans[source_hash] = plan
+    return plan
+
+
+def exportRegisterPlan(plan, path):
+    if path.lower().endswith(".csv"):
+        with open(path, "w", newline="", encoding="utf-8") as fp:
+            writer = csv.writer(fp)
+            writer.writerow(("group",) + REGISTER_FIELDS + RANGE_FIELDS)
+            for type, group in plan.groups.items():
+                for parameter in group:
+                    writer.writerow((type,) + parameter + plan.ranges.get(parameter[1], ("", "")))
+    else:
+        content = {type: [dict(zip(REGISTER_FIELDS + RANGE_FIELDS, parameter + plan.ranges.get(parameter[1], ())))
+                          for parameter in group]
+                   for type, group in plan.groups.items()}
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(content, fp, indent=1, ensure_ascii=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Validate the register map of the NuLite Flamingo HeatPump and export it as json or csv"
+    )
+    parser.add_argument("source", nargs="?", default=DEFAULT_SOURCE, help="Register map (.xlsx, .json or .csv)")
+    parser.add_argument("-o", "--output", dest="output", type=str, help="Export the validated map to this .json or .csv file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        plan = validateRows(LOADERS[os.path.splitext(args.source)[1].lower()](args.source))
+    except (KeyError, RegisterMapError) as _e:
+        logger.error(f"{_e}")
+        sys.exit(1)
+    for type, group in plan.groups.items():
+        logger.info(f"{type}: {len(group)} registers {group[0][0]}-{group[-1][0]}")
+    if args.output is not None:
+        exportRegisterPlan(plan, args.output)
+        logger.info(f"register map written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import math
+import time
+import logging
+
+from read_planner import ReadPlanner, ScanReport
+from transport import deviceTransport
+
+logger = logging.getLogger('Modbus')
+
+
+class ScanGroup():
+    def __init__(self, reader, interval):
+        # interval in seconds, 0 means the group is only read on demand
+        self.reader = reader
+        self.interval = interval
+        self.name = reader.type
+        self.next_due = 0.0
+        self.requested = True
+        self.scans = 0
+        self.failures = 0
+        self.overruns = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.duration_sum = 0.0
+
+    def isDue(self, now):
+        if self.interval > 0:
+            return now >= self.next_due
+        return self.requested
+
+    def scheduled(self, now, finished):
+        self.requested = False
+        if self.interval <= 0:
+            return
+        self.next_due += self.interval
+        if self.next_due <= finished:
+            # the bus could not keep up, skip the slots that already passed
+            missed = math.ceil((finished - self.next_due) / self.interval)
+            missed = max(missed, 1)
+            self.overruns += missed
+            self.next_due += missed * self.interval
+
+    def stats(self):
+        if self.scans == 0:
+            return f"{self.name}: no scans"
+        return (f"{self.name}: {self.scans} scans, {self.failures} failed, "
+                f"jitter mean {1000 * self.jitter_sum / self.scans:.1f} ms max {1000 * self.jitter_max:.1f} ms, "
+                f"scan mean {1000 * self.duration_sum / self.scans:.1f} ms, {self.overruns} overruns")
+
+
+class Scheduler():
+    def __init__(self, client, groups, output_path, unit=1, max_gap=8, max_count=125, stats_interval=60,
+                 clock=time.monotonic, sleep=time.sleep, metrics=None):
+        self.client = client
+        self.groups = groups
+        self.output_path = output_path
+        self.unit = unit
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self.stats_interval = stats_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.plans = {}
+        self.running = False
+        self.metrics = metrics
+        # groups due in the same tick share the transactions of one scan, its errors are counted once for the bus
+        self.scans = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.crc_errors = 0
+
+    def request(self, name):
+        # trigger an on demand read of a group, e.g. from a signal handler
+        for group in self.groups:
+            if group.name == name:
+                group.requested = True
+
+    def plan(self, groups):
+        # groups due in the same tick share one read plan, cached per combination
+        key = tuple(group.name for group in groups)
+        if key not in self.plans:
+            registers = [parameter for group in groups for parameter in group.reader.registers]
+            self.plans[key] = ReadPlanner(registers, self.max_gap, self.max_count)
+            logger.debug(f"read plan for {key}: {self.plans[key].requests}")
+        return self.plans[key]
+
+    def tick(self, now):
+        due = [group for group in self.groups if group.isDue(now)]
+        if not due:
+            return
+        started = self.clock()
+        for group in due:
+            if group.interval > 0 and group.next_due == 0.0:
+                group.next_due = now
+            jitter = started - group.next_due if group.interval > 0 else 0.0
+            group.jitter_sum += jitter
+            group.jitter_max = max(group.jitter_max, jitter)
+
+        report = ScanReport("+".join(group.name for group in due))
+        values = self.plan(due).execute(deviceTransport(self.client, self.unit), report)
+        if not any(values.valid):
+            logger.error(f"could not read {report.type} via modbus client")
+            values = None
+        finished = self.clock()
+        logger.debug(f"scan report {report}")
+        self.scans += 1
+        self.retries += report.retries
+        self.timeouts += report.timeouts
+        self.crc_errors += report.crc_errors
+
+        for group in due:
+            group.scans += 1
+            group.duration_sum += finished - started
+            if values is None:
+                group.failures += 1
+            else:
+                group.reader.decode(values)
+                group.reader.persist(self.output_path)
+            overruns = group.overruns
+            group.scheduled(now, finished)
+            if self.metrics is not None:
+                labels = (("group", group.name),)
+                self.metrics.observe("nulite_scan_seconds", labels, finished - started)
+                self.metrics.inc("nulite_scans_total", labels)
+                self.metrics.inc("nulite_overruns_total", labels, group.overruns - overruns)
+
+    def nextWakeup(self):
+        periodic = [group.next_due for group in self.groups if group.interval > 0]
+        return min(periodic) if periodic else None
+
+    def logStats(self):
+        for group in self.groups:
+            logger.info(f"scan stats {group.stats()}")
+        logger.info(f"scan stats bus: {self.scans} scans, {self.retries} retries, {self.timeouts} timeouts, "
+                    f"{self.crc_errors} crc errors")
+
+    def run(self, max_ticks=None):
+        self.running = True
+        ticks = 0
+        last_stats = self.clock()
+        while self.running and (max_ticks is None or ticks < max_ticks):
+            now = self.clock()
+            self.tick(now)
+            ticks += 1
+            now = self.clock()
+            if self.stats_interval > 0 and now - last_stats >= self.stats_interval:
+                self.logStats()
+                last_stats = now
+            wakeup = self.nextWakeup()
+            delay = 1.0 if wakeup is None else wakeup - now
+            # wake up at least once a second to serve on demand requests
+            self.sleep(min(max(delay, 0.0), 1.0))
+        self.logStats()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,233 @@
+import os
+import sys
+import tty
+import math
+import time
+import random
+import select
+import struct
+import logging
+import argparse
+import threading
+
+from pymodbus.utilities import computeCRC
+
+from register_map import loadRegisterPlan, DEFAULT_SOURCE
+
+logger = logging.getLogger('Modbus')
+
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+SLAVE_DEVICE_BUSY = 0x06
+
+# 8N1: start bit, 8 data bits, stop bit
+BITS_PER_CHAR = 10
+
+
+class SimulatedRegisters():
+    # register bank of one simulated heatpump, the meas values change with time
+    def __init__(self, plan, seed=0, readable_holes=True):
+        self.random = random.Random(seed)
+        self.started = time.monotonic()
+        self.registers = {parameter[0]: parameter for parameter in plan.registers()}
+        self.ranges = plan.ranges
+        self.readable_holes = readable_holes
+        self.writes = {}
+        self.phases = {address: self.random.uniform(0, 2 * math.pi) for address in self.registers}
+        self.states = {address: self.random.randint(0, 1) for address in self.registers}
+        spans = {}
+        for address, parameter in self.registers.items():
+            spans.setdefault(parameter[1][0], []).append(address)
+        self.spans = [(min(group), max(group)) for group in spans.values()]
+        self.lock = threading.Lock()
+
+    def physical(self, parameter, now):
+        address, name, description, scale, offset = parameter
+        if name in self.ranges:
+            minimum, maximum = self.ranges[name]
+            middle, amplitude = (minimum + maximum) / 2, (maximum - minimum) / 8
+        else:
+            middle, amplitude = (40.0, 5.0) if scale == 0.5 else (2.0, 0.3) if scale != 0 else (0, 0)
+        if name.startswith("P"):
+            # settings do not move
+            return round(middle)
+        if scale == 0:
+            if amplitude == 0:
+                # switch states flip rarely
+                if self.random.random() < 0.01:
+                    self.states[address] ^= 1
+                return self.states[address]
+            return round(middle + amplitude * math.sin(now / 60 + self.phases[address]))
+        noise = self.random.gauss(0, amplitude / 20)
+        return middle + amplitude * math.sin(now / 120 + self.phases[address]) + noise
+
+    def raw(self, address):
+        if address in self.writes:
+            return self.writes[address]
+        parameter = self.registers.get(address)
+        if parameter is None:
+            return 0
+        value = self.physical(parameter, time.monotonic() - self.started)
+        scale = parameter[3]
+        raw = round(value / scale - parameter[4]) if scale != 0 else int(value)
+        return raw & 0xFFFF
+
+    def __contains__(self, address):
+        if address in self.registers:
+            return True
+        # the holes between the mapped registers (84, 87, 88, ...) answer like the real controller
+        return self.readable_holes and any(start <= address <= end for start, end in self.spans)
+
+    def __getitem__(self, address):
+        with self.lock:
+            return self.raw(address)
+
+    def write(self, address, value):
+        with self.lock:
+            self.writes[address] = value & 0xFFFF
+
+
+class NuliteSimulator():
+    # modbus RTU slave on the master side of a pty pair, the client opens self.port
+    def __init__(self, plan=None, units=(1,), baudrate=9600, turnaround=0.005, timeout_rate=0.0, exception_rate=0.0,
+                 crc_error_rate=0.0, max_count=125, readable_holes=True, seed=0):
+        plan = plan if plan is not None else loadRegisterPlan()
+        self.banks = {unit: SimulatedRegisters(plan, seed + unit, readable_holes) for unit in units}
+        self.baudrate = baudrate
+        self.turnaround = turnaround
+        self.timeout_rate = timeout_rate
+        self.exception_rate = exception_rate
+        self.crc_error_rate = crc_error_rate
+        self.max_count = max_count
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    def wireTime(self, size):
+        return size * BITS_PER_CHAR / self.baudrate
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="nulite-simulator", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def readFrame(self):
+        # collect bytes until the line is silent for 3.5 character times
+        frame = b""
+        silence = max(3.5 * self.wireTime(1), 0.002)
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], silence if frame else 0.1)
+            if not ready:
+                if frame:
+                    return frame
+                continue
+            frame += os.read(self.master, 256)
+        return None
+
+    def send(self, frame):
+        # pace the response like the serial line would
+        chunk = 16
+        for index in range(0, len(frame), chunk):
+            time.sleep(self.wireTime(len(frame[index:index + chunk])))
+            os.write(self.master, frame[index:index + chunk])
+        self.bytes_sent += len(frame)
+
+    def serve(self):
+        while self.running:
+            frame = self.readFrame()
+            if not frame or len(frame) < 4:
+                continue
+            self.bytes_received += len(frame)
+            if struct.unpack(">H", frame[-2:])[0] != computeCRC(frame[:-2]):
+                logger.debug(f"simulator: crc error in {frame.hex()}")
+                continue
+            unit = frame[0]
+            if unit not in self.banks:
+                continue
+            self.requests += 1
+            if self.random.random() < self.timeout_rate:
+                continue
+            time.sleep(self.turnaround)
+            response = self.respond(self.banks[unit], frame[1], frame[2:-2])
+            response = bytes([unit]) + response
+            response += struct.pack(">H", computeCRC(response))
+            if self.random.random() < self.crc_error_rate:
+                response = response[:-1] + bytes([response[-1] ^ 0xFF])
+            self.send(response)
+
+    def respond(self, bank, function, payload):
+        if self.random.random() < self.exception_rate:
+            return bytes([function | 0x80, SLAVE_DEVICE_BUSY])
+        if function == 0x03 and len(payload) == 4:
+            address, count = struct.unpack(">HH", payload)
+            if not 1 <= count <= self.max_count:
+                return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+            if any(register not in bank for register in range(address, address + count)):
+                return bytes([function | 0x80, ILLEGAL_DATA_ADDRESS])
+            values = [bank[register] for register in range(address, address + count)]
+            return bytes([function, 2 * count]) + struct.pack(f">{count}H", *values)
+        if function == 0x06 and len(payload) == 4:
+            address, value = struct.unpack(">HH", payload)
+            if address not in bank:
+                return bytes([function | 0x80, ILLEGAL_DATA_ADDRESS])
+            bank.write(address, value)
+            return bytes([function]) + payload
+        if function == 0x10 and len(payload) >= 5:
+            address, count, size = struct.unpack(">HHB", payload[:5])
+            if size != 2 * count or len(payload) != 5 + size:
+                return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+            if any(register not in bank for register in range(address, address + count)):
+                return bytes([function | 0x80, ILLEGAL_DATA_ADDRESS])
+            for index, value in enumerate(struct.unpack(f">{count}H", payload[5:])):
+                bank.write(address + index, value)
+            return bytes([function]) + payload[:4]
+        return bytes([function | 0x80, ILLEGAL_FUNCTION])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulated NuLite Flamingo HeatPump, modbus RTU slave on a local pty"
+    )
+    parser.add_argument("--map", dest="map", default=DEFAULT_SOURCE, type=str, help="Register map")
+    parser.add_argument("--units", dest="units", default="1", type=str, help="Comma separated unit ids to answer")
+    parser.add_argument("--baud", dest="baud", default=9600, type=int, help="Baud rate used to model the wire time")
+    parser.add_argument("--turnaround", dest="turnaround", default=0.005, type=float, help="Slave turnaround delay in seconds")
+    parser.add_argument("--timeout-rate", dest="timeout_rate", default=0.0, type=float, help="Share of requests left unanswered")
+    parser.add_argument("--exception-rate", dest="exception_rate", default=0.0, type=float, help="Share of requests answered with slave device busy")
+    parser.add_argument("--crc-error-rate", dest="crc_error_rate", default=0.0, type=float, help="Share of responses with a broken crc")
+    parser.add_argument("--max-count", dest="max_count", default=125, type=int, help="Largest read request the slave accepts")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    simulator = NuliteSimulator(loadRegisterPlan(args.map), [int(unit) for unit in args.units.split(",")], args.baud,
+                                args.turnaround, args.timeout_rate, args.exception_rate, args.crc_error_rate,
+                                args.max_count).start()
+    print(f"simulated heatpump listening on {simulator.port}", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+    logger.info(f"simulator served {simulator.requests} requests")
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
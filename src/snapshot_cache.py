@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger('Modbus')
+
+# default deadband of the temperatures (data accuracy 0.5 degC): a flicker by one step is not persisted,
+# everything else has to match exactly
+TEMPERATURE_DEADBAND = 0.5
+
+
+class SnapshotCache():
+    # last persisted values per series, kept on disk so single shot runs compare against the previous run;
+    # a scan is only compared here, the reference moves with commit() once the scan was actually written
+    def __init__(self, path, keyframe_interval=3600, deadbands=None):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.deadbands = deadbands if deadbands is not None else {}
+        self.snapshots = {}
+        self.skipped = 0
+        # commits come from the writer thread
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as fp:
+                self.snapshots = json.load(fp)
+        except (OSError, ValueError) as _e:
+            logger.warning(f"could not load the snapshot cache {self.path}, starting with a keyframe: {_e}")
+            self.snapshots = {}
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as fp:
+            json.dump(self.snapshots, fp)
+        os.replace(self.path + ".tmp", self.path)
+
+    def deadband(self, register_map, index):
+        name = register_map.names[index]
+        if name in self.deadbands:
+            return self.deadbands[name]
+        return TEMPERATURE_DEADBAND if register_map.signed[index] and register_map.scales[index] == 0.5 else 0
+
+    @staticmethod
+    def digest(raw, valid):
+        return hashlib.sha1(b"".join(int(value).to_bytes(2, "little") for value in raw) + bytes(bool(value) for value in valid)).hexdigest()
+
+    def unchanged(self, series, raw, valid):
+        # parameter scans: an identical scan is not persisted at all
+        with self.lock:
+            snapshot = self.snapshots.get(series)
+            if snapshot is not None and snapshot.get("hash") == self.digest(raw, valid):
+                self.skipped += 1
+                return True
+        return False
+
+    def commitDigest(self, series, raw, valid, timestamp):
+        with self.lock:
+            self.snapshots[series] = {"hash": self.digest(raw, valid), "timestamp": timestamp}
+            self.save()
+
+    def isKeyframe(self, snapshot, register_map, timestamp):
+        return (snapshot is None or snapshot.get("names") != register_map.names
+                or timestamp - snapshot["keyframe"] >= self.keyframe_interval)
+
+    def changes(self, series, register_map, raw, values, valid, timestamp):
+        # returns None when nothing has to be persisted, otherwise the indices of the registers to write,
+        # all of them for a keyframe
+        everything = list(range(len(register_map)))
+        with self.lock:
+            snapshot = self.snapshots.get(series)
+            if self.isKeyframe(snapshot, register_map, timestamp):
+                return everything
+            changed = []
+            reference, reference_valid = snapshot["values"], snapshot["valid"]
+            for index in everything:
+                if bool(valid[index]) != reference_valid[index]:
+                    changed.append(index)
+                elif valid[index]:
+                    deadband = self.deadband(register_map, index)
+                    difference = abs(float(values[index]) - reference[index])
+                    # a value within +-deadband of the reference is not a change, one step of 0.5 degC is still noise
+                    if difference > deadband:
+                        changed.append(index)
+            if not changed:
+                self.skipped += 1
+                return None
+        return changed
+
+    def commit(self, series, register_map, values, valid, timestamp, indices):
+        # the scan with these changes was written: the reference only moves for the registers that were written,
+        # slow drifts still get through; a dropped scan is never committed, so its changes are found again
+        with self.lock:
+            snapshot = self.snapshots.get(series)
+            if self.isKeyframe(snapshot, register_map, timestamp):
+                self.snapshots[series] = {"names": register_map.names, "keyframe": timestamp,
+                                          "values": [float(value) for value in values], "valid": [bool(value) for value in valid]}
+            else:
+                for index in indices:
+                    snapshot["values"][index] = float(values[index])
+                    snapshot["valid"][index] = bool(valid[index])
+            self.save()
+
+
+def parseDeadbands(text):
+    # "C02=1.0,C17=0.2"
+    deadbands = {}
+    for item in (text or "").split(","):
+        if item.strip():
+            name, _, value = item.partition("=")
+            deadbands[name.strip()] = float(value)
+    return deadbands
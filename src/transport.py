@@ -0,0 +1,175 @@
+import time
+import logging
+import weakref
+
+from read_planner import (REQUEST_FRAME_BYTES, RESPONSE_FRAME_BYTES, READ_HOLDING_REGISTERS, WRITE_SINGLE_REGISTER,
+                          WRITE_MULTIPLE_REGISTERS)
+
+logger = logging.getLogger('Modbus')
+
+# 8N1: start bit, 8 data bits, stop bit
+BITS_PER_CHAR = 10
+
+# smoothing of the learned latency, the same gains as the TCP retransmission timer (RFC 6298)
+LATENCY_GAIN = 1 / 8
+DEVIATION_GAIN = 1 / 4
+
+# exception codes of a busy slave or gateway, the same request may pass later; every other code is final
+ACKNOWLEDGE = 0x05
+SLAVE_DEVICE_BUSY = 0x06
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+GATEWAY_TARGET_NO_RESPONSE = 0x0B
+TRANSIENT_EXCEPTIONS = (ACKNOWLEDGE, SLAVE_DEVICE_BUSY, GATEWAY_PATH_UNAVAILABLE, GATEWAY_TARGET_NO_RESPONSE)
+
+_transports = weakref.WeakKeyDictionary()
+_counters = weakref.WeakKeyDictionary()
+
+
+class ReceiveCounter():
+    # counts the bytes a client takes off the line: pymodbus reports a response that failed the crc / framing
+    # check with the same io error as no response at all, only the received bytes tell them apart
+    def __init__(self, client):
+        self.received = 0
+        recv = client.recv
+
+        def counted(size):
+            data = recv(size)
+            self.received += len(data or b"")
+            return data
+        client.recv = counted
+
+
+def receiveCounter(client):
+    # None for clients without a line to count on, e.g. the in-memory client
+    if not callable(getattr(client, "recv", None)):
+        return None
+    if client not in _counters:
+        _counters[client] = ReceiveCounter(client)
+    return _counters[client]
+
+
+class AdaptiveTransport():
+    # request path to one unit on a bus: learns the response latency of the device beyond the wire time,
+    # derives the timeout of every request from it and retries failed requests with a bounded backoff
+    def __init__(self, client, unit=1, retries=2, backoff=0.05, max_backoff=1.0, initial_latency=0.1,
+                 min_timeout=0.05, max_timeout=3.0):
+        self.client = client
+        self.unit = unit
+        self.baudrate = getattr(client, "baudrate", 9600) or 9600
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.initial_latency = initial_latency
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.latency = None
+        self.deviation = None
+        self.metrics = None
+        self.counter = receiveCounter(client)
+
+    def wireTime(self, count):
+        return (REQUEST_FRAME_BYTES + RESPONSE_FRAME_BYTES + 2 * count) * BITS_PER_CHAR / self.baudrate
+
+    def timeout(self, count):
+        if self.latency is None:
+            margin = self.initial_latency
+        else:
+            margin = self.latency + 4 * self.deviation
+        return min(max(self.wireTime(count) + margin, self.min_timeout), self.max_timeout)
+
+    def learn(self, latency):
+        latency = max(latency, 0.0)
+        if self.latency is None:
+            self.latency = latency
+            self.deviation = latency / 2
+        else:
+            self.deviation += DEVIATION_GAIN * (abs(self.latency - latency) - self.deviation)
+            self.latency += LATENCY_GAIN * (latency - self.latency)
+
+    def missed(self):
+        # no answer in time: widen the margin so a slow device is not hammered with short timeouts
+        if self.latency is not None:
+            self.deviation = min(2 * self.deviation + 0.001, self.max_timeout)
+
+    def applyTimeout(self, timeout):
+        self.client.timeout = timeout
+        socket = getattr(self.client, "socket", None)
+        if socket is not None and hasattr(socket, "timeout"):
+            socket.timeout = timeout
+
+    def read(self, start, count, report):
+        return self.transaction(start, count, report, lambda: self.client.read_holding_registers(start, count, unit=self.unit)) # start_address, count, slave_id
+
+    def write(self, start, values, report, single=False):
+        # function code 0x10, or 0x06 for one register when the device does not know 0x10
+        if single:
+            return self.transaction(start, 1, report, lambda: self.client.write_register(start, values[0], unit=self.unit),
+                                    WRITE_SINGLE_REGISTER)
+        return self.transaction(start, len(values), report, lambda: self.client.write_registers(start, values, unit=self.unit),
+                                WRITE_MULTIPLE_REGISTERS)
+
+    def transaction(self, start, count, report, perform, function=READ_HOLDING_REGISTERS):
+        # returns the last response, an error response once the retries are used up
+        write = function != READ_HOLDING_REGISTERS
+        response = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                report.retries += 1
+                time.sleep(min(self.backoff * 2 ** (attempt - 1), self.max_backoff))
+            self.applyTimeout(self.timeout(count))
+            started = time.monotonic()
+            received = self.counter.received if self.counter is not None else 0
+            try:
+                response = perform()
+            except Exception as _e:
+                logger.warning(f"unit {self.unit}: {'write' if write else 'read'} of {count} registers at {start} failed {_e}")
+                response = None
+            elapsed = time.monotonic() - started
+            # an io error after bytes arrived is a garbled response, without any bytes the device did not answer
+            corrupt = self.counter is not None and self.counter.received > received
+            sent, received = report.bytes_sent, report.bytes_received
+            report.addRequest(count, response, function)
+            if self.metrics is not None:
+                self.record(report, start, response, elapsed, write, report.bytes_sent - sent, report.bytes_received - received, corrupt)
+            if response is None or (response.isError() and not hasattr(response, "exception_code")):
+                if corrupt:
+                    report.crc_errors += 1
+                else:
+                    report.timeouts += 1
+                    self.missed()
+                continue
+            self.learn(elapsed - self.wireTime(count if not response.isError() else 0))
+            if not response.isError():
+                return response
+            report.exceptions += 1
+            if response.exception_code not in TRANSIENT_EXCEPTIONS:
+                # retrying does not help, the caller splits the request, changes the function or gives up
+                return response
+        return response
+
+    def record(self, report, start, response, elapsed, write, sent, received, corrupt):
+        metrics = self.metrics
+        labels = (("reader", report.type), ("unit", self.unit))
+        metrics.observe("nulite_request_seconds", labels + (("function", "write" if write else "read"), ("start", start)), elapsed)
+        metrics.inc("nulite_requests_total", labels)
+        metrics.inc("nulite_bytes_sent_total", labels, sent)
+        metrics.inc("nulite_bytes_received_total", labels, received)
+        if response is None or (response.isError() and not hasattr(response, "exception_code")):
+            if corrupt:
+                metrics.inc("nulite_crc_errors_total", labels)
+            else:
+                metrics.inc("nulite_timeouts_total", labels)
+        elif response.isError():
+            metrics.inc("nulite_exception_responses_total", labels + (("code", response.exception_code),))
+
+    def __repr__(self):
+        latency = "unknown" if self.latency is None else f"{1000 * self.latency:.1f} ms"
+        return f"AdaptiveTransport(unit={self.unit}, latency {latency}, timeout {1000 * self.timeout(1):.0f} ms + wire time)"
+
+
+def deviceTransport(client, unit=1):
+    # one transport per client and unit, so every device keeps its learned latency
+    units = _transports.setdefault(client, {})
+    if unit not in units:
+        units[unit] = AdaptiveTransport(client, unit)
+    return units[unit]
@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import bisect
+import logging
+import argparse
+from datetime import datetime
+
+from register_map import CompiledRegisterMap
+
+logger = logging.getLogger('Modbus')
+
+MAGIC = b"NTS1"
+VERSION = 1
+# magic, version, number of registers, length of the json metadata
+HEADER = struct.Struct("<4sHHI")
+# timestamp, record number
+INDEX_ENTRY = struct.Struct("<dQ")
+FILE_EXTENSION = ".nts"
+INDEX_EXTENSION = ".idx"
+
+
+def recordStruct(count):
+    # timestamp, raw uint16 register vector, bit mask of the registers that could be read
+    return struct.Struct(f"<d{count}H{(count + 7) // 8}s")
+
+
+def packMask(valid):
+    count = len(valid)
+    if all(valid):
+        return bytes([0xFF] * (count // 8)) + (bytes([(1 << (count % 8)) - 1]) if count % 8 else b"")
+    mask = bytearray((count + 7) // 8)
+    for index, value in enumerate(valid):
+        if value:
+            mask[index >> 3] |= 1 << (index & 7)
+    return bytes(mask)
+
+
+def unpackMask(mask, count):
+    return [bool(mask[index >> 3] & (1 << (index & 7))) for index in range(count)]
+
+
+class SeriesFile():
+    # one append-only file of fixed width records, all records of a file share the register layout in its header
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            magic, version, count, meta_length = HEADER.unpack(fp.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a time series file of version {VERSION}")
+            self.meta = json.loads(fp.read(meta_length).decode("utf-8"))
+        self.count = count
+        self.header_size = HEADER.size + meta_length
+        self.record = recordStruct(count)
+        self.index = self.loadIndex()
+
+    @staticmethod
+    def create(path, meta):
+        content = json.dumps(meta).encode("utf-8")
+        content += b" " * (-(HEADER.size + len(content)) % 8)
+        with open(path, "wb") as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, len(meta["addresses"]), len(content)))
+            fp.write(content)
+        return SeriesFile(path)
+
+    def loadIndex(self):
+        path = os.path.splitext(self.path)[0] + INDEX_EXTENSION
+        if not os.path.isfile(path):
+            return []
+        with open(path, "rb") as fp:
+            content = fp.read()
+        return [INDEX_ENTRY.unpack_from(content, offset) for offset in range(0, len(content) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+
+    def records(self):
+        return (os.path.getsize(self.path) - self.header_size) // self.record.size
+
+    def read(self, start=None, end=None):
+        # yields (timestamp, raw, valid) of the records within [start, end], located via the sparse index
+        total = self.records()
+        if total == 0:
+            return
+        first = 0
+        if start is not None and self.index:
+            position = bisect.bisect_right([entry[0] for entry in self.index], start) - 1
+            first = self.index[position][1] if position >= 0 else 0
+        with open(self.path, "rb") as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for number in range(first, total):
+                    values = self.record.unpack_from(view, self.header_size + number * self.record.size)
+                    timestamp = values[0]
+                    if start is not None and timestamp < start:
+                        continue
+                    if end is not None and timestamp > end:
+                        break
+                    yield timestamp, values[1:-1], unpackMask(values[-1], self.count)
+
+    def span(self):
+        total = self.records()
+        if total == 0:
+            return None
+        with open(self.path, "rb") as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                first = struct.unpack_from("<d", view, self.header_size)[0]
+                last = struct.unpack_from("<d", view, self.header_size + (total - 1) * self.record.size)[0]
+        return first, last
+
+
+class SeriesWriter():
+    def __init__(self, directory, series, meta, max_bytes, index_stride):
+        self.directory = directory
+        self.series = series
+        self.meta = meta
+        self.max_bytes = max_bytes
+        self.index_stride = index_stride
+        self.file = None
+        self.day = None
+        self.records = 0
+
+    def open(self, day):
+        # continue the last file of the day if it has the same layout and room left, otherwise rotate
+        existing = sorted(name for name in os.listdir(self.directory)
+                          if name.startswith(f"{self.series}_{day}_") and name.endswith(FILE_EXTENSION))
+        sequence = 0
+        if existing:
+            path = os.path.join(self.directory, existing[-1])
+            sequence = int(os.path.splitext(existing[-1])[0].rsplit("_", 1)[1])
+            try:
+                series_file = SeriesFile(path)
+            except ValueError:
+                series_file = None
+            if series_file is not None and series_file.meta == self.meta and os.path.getsize(path) < self.max_bytes:
+                # drop a partly written record of an interrupted run
+                records = series_file.records()
+                with open(path, "r+b") as fp:
+                    fp.truncate(series_file.header_size + records * series_file.record.size)
+                self.file, self.day, self.records = series_file, day, records
+                return
+            sequence += 1
+        path = os.path.join(self.directory, f"{self.series}_{day}_{sequence:03d}{FILE_EXTENSION}")
+        self.file, self.day, self.records = SeriesFile.create(path, self.meta), day, 0
+
+    def append(self, timestamp, raw, valid):
+        day = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+        if self.file is None or day != self.day:
+            self.open(day)
+        elif self.file.header_size + (self.records + 1) * self.file.record.size > self.max_bytes:
+            self.rotate(day)
+        with open(self.file.path, "ab") as fp:
+            fp.write(self.file.record.pack(timestamp, *[int(value) for value in raw], packMask(valid)))
+        if self.records % self.index_stride == 0:
+            with open(os.path.splitext(self.file.path)[0] + INDEX_EXTENSION, "ab") as fp:
+                fp.write(INDEX_ENTRY.pack(timestamp, self.records))
+        self.records += 1
+
+    def rotate(self, day):
+        sequence = int(os.path.splitext(self.file.path)[0].rsplit("_", 1)[1]) + 1
+        path = os.path.join(self.directory, f"{self.series}_{day}_{sequence:03d}{FILE_EXTENSION}")
+        self.file, self.day, self.records = SeriesFile.create(path, self.meta), day, 0
+
+
+class TimeSeriesStore():
+    # one directory per series (reader type, prefixed with the device for fleets), files rotated per day and size
+    def __init__(self, root, max_bytes=64 * 1024 * 1024, index_stride=64):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_stride = index_stride
+        self.writers = {}
+
+    @staticmethod
+    def metadata(register_map):
+        return {"addresses": list(register_map.addresses), "names": register_map.names,
+                "descriptions": register_map.descriptions, "scales": list(register_map.scales),
+                "offsets": list(register_map.offsets), "signed": [bool(signed) for signed in register_map.signed]}
+
+    def append(self, series, register_map, timestamp, raw, valid):
+        entry = self.writers.get(series)
+        if entry is None or entry[0] is not register_map:
+            meta = self.metadata(register_map)
+            if entry is None or entry[1].meta != meta:
+                directory = os.path.join(self.root, series)
+                os.makedirs(directory, exist_ok=True)
+                writer = SeriesWriter(directory, series, meta, self.max_bytes, self.index_stride)
+            else:
+                writer = entry[1]
+            entry = self.writers[series] = (register_map, writer)
+        entry[1].append(timestamp, raw, valid)
+
+    def series(self):
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def files(self, series):
+        directory = os.path.join(self.root, series)
+        return [SeriesFile(os.path.join(directory, name)) for name in sorted(os.listdir(directory)) if name.endswith(FILE_EXTENSION)]
+
+    def query(self, series, start=None, end=None):
+        # yields (SeriesFile, timestamp, raw, valid) for the scans of a series within [start, end]
+        for series_file in self.files(series):
+            span = series_file.span()
+            if span is None or (start is not None and span[1] < start) or (end is not None and span[0] > end):
+                continue
+            for timestamp, raw, valid in series_file.read(start, end):
+                yield series_file, timestamp, raw, valid
+
+
+def registerMap(meta):
+    scales = [scale if signed else 0 for scale, signed in zip(meta["scales"], meta["signed"])]
+    return CompiledRegisterMap(list(zip(meta["addresses"], meta["names"], meta["descriptions"], scales, meta["offsets"])))
+
+
+def exportLegacyCsv(store, series, output_path, start=None, end=None):
+    # one csv per scan in the layout of ReaderBase.writeDataToFile
+    maps = {}
+    written = 0
+    for series_file, timestamp, raw, valid in store.query(series, start, end):
+        register_map = maps.setdefault(series_file.path, registerMap(series_file.meta))
+        raw, values = register_map.decodeColumns(raw)
+        rows = register_map.formatRows(raw, values, valid)
+        base = os.path.join(output_path, f"{series}_{datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d_%H-%M-%S')}")
+        path, duplicate = f"{base}.csv", 1
+        while os.path.exists(path):
+            # several scans within one second
+            path, duplicate = f"{base}_{duplicate}.csv", duplicate + 1
+        with open(path, "w") as fp:
+            fp.write("name, value, description, register, raw_value \n")
+            for line in rows:
+                fp.write(line + '\n')
+        written += 1
+    return written
+
+
+def exportWideCsv(store, series, file_path, start=None, end=None):
+    # one row per scan, one column per register, missing registers stay empty
+    written = 0
+    columns = None
+    maps = {}
+    with open(file_path, "w") as fp:
+        for series_file, timestamp, raw, valid in store.query(series, start, end):
+            register_map = maps.setdefault(series_file.path, registerMap(series_file.meta))
+            if columns is None:
+                columns = register_map.names
+                fp.write("timestamp, " + ", ".join(columns) + "\n")
+            raw, values = register_map.decodeColumns(raw)
+            by_name = {name: (f"{float(values[index]):.2f}" if register_map.signed[index] else f"{int(raw[index])}") if valid[index] else ""
+                       for index, name in enumerate(register_map.names)}
+            fp.write(datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") + ", "
+                     + ", ".join(by_name.get(name, "") for name in columns) + "\n")
+            written += 1
+    return written
+
+
+def parseTime(text):
+    if text is None:
+        return None
+    return datetime.fromisoformat(text).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export scans of the time series store to csv"
+    )
+    parser.add_argument("store", help="Store folder (the store folder inside the output folder of the readout)")
+    parser.add_argument("-s", "--series", dest="series", type=str, help="Series to export, all when omitted")
+    parser.add_argument("--from", dest="start", type=str, help="First scan time, e.g. 2024-06-03 or 2024-06-03T12:00")
+    parser.add_argument("--to", dest="end", type=str, help="Last scan time")
+    parser.add_argument("--legacy", dest="legacy", type=str, help="Folder for one csv per scan in the readout layout")
+    parser.add_argument("--wide", dest="wide", type=str, help="Folder for one csv per series with one row per scan")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = TimeSeriesStore(args.store)
+    start, end = parseTime(args.start), parseTime(args.end)
+    for series in ([args.series] if args.series else store.series()):
+        if args.legacy is None and args.wide is None:
+            files = store.files(series)
+            logger.info(f"{series}: {sum(series_file.records() for series_file in files)} scans in {len(files)} files")
+        if args.legacy is not None:
+            logger.info(f"{series}: {exportLegacyCsv(store, series, args.legacy, start, end)} csv files written to {args.legacy}")
+        if args.wide is not None:
+            path = os.path.join(args.wide, f"{series}.csv")
+            logger.info(f"{series}: {exportWideCsv(store, series, path, start, end)} scans written to {path}")
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
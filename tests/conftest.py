@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# the scripts in src import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import register_map
+from register_map import loadRegisterPlan
+
+
+@pytest.fixture(scope="session")
+def plan():
+    # compiled from the vendor sheet without the on disk cache, the tests leave ~/.cache alone
+    return loadRegisterPlan(cache_dir=None)
+
+
+@pytest.fixture(params=["numpy", "python"])
+def decode_path(request, monkeypatch):
+    # runs a test with the numpy and with the pure python decode of the compiled register map
+    if request.param == "python":
+        monkeypatch.setattr(register_map, "np", None)
+    elif register_map.np is None:
+        pytest.skip("numpy is not installed")
+    return request.param
+
+
+class RecordingSink():
+    # a writer pipeline sink that keeps the scans it wrote, a blocked one holds the writer thread until release is set
+    def __init__(self, blocked=False):
+        self.release = threading.Event()
+        if not blocked:
+            self.release.set()
+        self.batches = []
+
+    def write(self, batches):
+        self.release.wait()
+        self.batches.extend(batches)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sink():
+    return RecordingSink()
+
+
+@pytest.fixture
+def blocked_sink():
+    sink = RecordingSink(blocked=True)
+    yield sink
+    # a failed test must not leave the writer thread waiting
+    sink.release.set()
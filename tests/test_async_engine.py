@@ -0,0 +1,53 @@
+import asyncio
+
+from async_engine import PortWorker, Target
+from memory_client import MemoryModbusClient
+from read_planner import ReadPlanner
+from transport import deviceTransport
+
+
+class PlannedReader():
+    def __init__(self, type):
+        self.type = type
+        self.planner = ReadPlanner([(address, f"C{address}", "", 0, 0) for address in range(4)])
+        self.metrics = None
+        self.raw = []
+        self.values = []
+
+    def decode(self, values):
+        self.raw = self.values = list(values.registers)
+
+
+def cycle(worker):
+    worker.schedule()
+    asyncio.run(worker.drain())
+
+
+def test_a_dead_unit_is_skipped_with_a_growing_backoff():
+    # unit 2 does not answer until it is switched on
+    client = MemoryModbusClient({1: {address: address for address in range(4)}}, timeout=0.001)
+    alive, dead = Target("bus", 1), Target("bus", 2)
+    for target in (alive, dead):
+        target.readers = [PlannedReader("Parameters"), PlannedReader("MeasValues")]
+        deviceTransport(client, target.unit).retries = 0
+    results = []
+    worker = PortWorker("bus", client, [alive, dead], results.append)
+    try:
+        cycle(worker)
+        # the second reader of the dead unit is not tried in the same cycle
+        assert [(result.target.unit, result.error is None) for result in results] == [(1, True), (1, True), (2, False)]
+        assert (dead.failures, dead.skip) == (1, 1)
+        requests = client.requests
+        cycle(worker)
+        assert client.requests == requests + 2
+        cycle(worker)
+        assert (dead.failures, dead.skip) == (2, 2)
+        client.units[2] = {address: address for address in range(4)}
+        results.clear()
+        for _ in range(3):
+            cycle(worker)
+        assert [result.target.unit for result in results].count(2) == 2
+        assert (dead.failures, dead.skip) == (0, 0)
+        assert all(result.error is None for result in results)
+    finally:
+        worker.close()
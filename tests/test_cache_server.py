@@ -0,0 +1,27 @@
+import threading
+
+from memory_client import MemoryModbusClient
+from cache_server import RegisterCache
+
+
+def test_concurrent_requests_for_one_block_share_one_transaction(plan):
+    client = MemoryModbusClient({1: {address: 100 + address for address in range(300)}}, latency=0.05)
+    cache = RegisterCache(client, plan, default_ttl=60)
+    results = {}
+    threads = [threading.Thread(target=lambda name=name: results.update(cache.query(name))) for name in ("C02", "C03", "C04")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.requests == 1
+    assert cache.stats()["transactions"] == 1
+    assert results["C03"]["raw"] == 303
+
+
+def test_fresh_registers_come_from_the_cache(plan):
+    client = MemoryModbusClient({1: {address: address for address in range(300)}})
+    cache = RegisterCache(client, plan, default_ttl=60)
+    cache.query("MeasValues")
+    requests = client.requests
+    assert cache.query("C02,C17")["C17"]["raw"] == 217
+    assert client.requests == requests
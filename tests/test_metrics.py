@@ -0,0 +1,27 @@
+from metrics import Metrics
+from pipeline import WriterPipeline, ScanBatch
+
+
+def test_every_series_has_help_and_type():
+    metrics = Metrics()
+    metrics.inc("nulite_requests_total", (("reader", "MeasValues"), ("unit", 1)))
+    metrics.observe("nulite_request_seconds", (("reader", "MeasValues"),), 0.02)
+    text = metrics.render()
+    names = {line.split("{")[0].split(" ")[0] for line in text.splitlines() if not line.startswith("#")}
+    typed = {line.split(" ")[2] for line in text.splitlines() if line.startswith("# TYPE")}
+    assert "nulite_uptime_seconds" in typed
+    assert {name.rsplit("_bucket", 1)[0].rsplit("_sum", 1)[0].rsplit("_count", 1)[0] for name in names} <= typed
+    assert 'nulite_request_seconds_bucket{reader="MeasValues",le="0.025"} 1' in text
+
+
+def test_queue_depth_includes_the_submitted_scan(blocked_sink):
+    metrics = Metrics()
+    sink = blocked_sink
+    pipeline = WriterPipeline([sink], max_queue=4)
+    pipeline.metrics = metrics
+    for number in range(3):
+        pipeline.submit(ScanBatch("MeasValues", float(number), []))
+    depth = metrics.values[("nulite_writer_queue_depth", ())]
+    assert depth == pipeline.queue.qsize() and depth >= 2
+    sink.release.set()
+    pipeline.close()
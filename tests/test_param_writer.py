@@ -0,0 +1,55 @@
+import pytest
+from pymodbus.register_write_message import WriteMultipleRegistersResponse, WriteSingleRegisterResponse
+
+from memory_client import MemoryModbusClient
+from param_writer import ParameterWriter
+from read_heat_pump_values import ParameterReader
+from read_planner import ScanReport, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS
+
+
+def parameterClient(plan, **options):
+    # a bank with the registers of the map only, the unused register 84 and the passwords at 87/88 do not exist
+    return MemoryModbusClient({1: {parameter[0]: 1 for parameter in plan.groups["Parameters"]}}, **options)
+
+
+def test_plan_bridges_gaps_only_with_mapped_registers(plan):
+    writer = ParameterWriter(ParameterReader(parameterClient(plan), plan=plan), max_count=8, max_gap=2)
+    current = {address: 1 for address in range(91)}
+    requests = writer.plan({80: 5, 82: 6, 83: 7, 85: 8, 86: 9, 89: 10}, current)
+    assert [(request.start, request.values) for request in requests] == [(80, [5, 1, 6, 7]), (85, [8, 9]), (89, [10])]
+    assert requests[0].names == ["P80", "P81", "P82", "P83"]
+
+
+def test_plan_respects_max_count(plan):
+    writer = ParameterWriter(ParameterReader(parameterClient(plan), plan=plan), max_count=3, max_gap=2)
+    requests = writer.plan({80: 5, 82: 6, 83: 7}, {address: 1 for address in range(91)})
+    assert [(request.start, len(request.values)) for request in requests] == [(80, 3), (83, 1)]
+
+
+@pytest.mark.parametrize("multiple_writes", [True, False])
+def test_apply_writes_and_verifies_the_changes(plan, multiple_writes):
+    client = parameterClient(plan, multiple_writes=multiple_writes)
+    writer = ParameterWriter(ParameterReader(client, plan=plan))
+    report = writer.apply({"P80": 0.05, "P82": 0.5, "P83": 1, "P84": 40, "P88": -3})
+    assert (report.changes, len(report.mismatches), len(report.rejected)) == (4, 0, 0)
+    assert report.verified == 5
+    registers = client.units[1]
+    assert (registers[80], registers[81], registers[82], registers[85], registers[89]) == (5, 1, 50, 40, 0xFFFD)
+    assert not any(address in registers for address in (84, 87, 88))
+    assert writer.single is not multiple_writes
+
+
+def test_apply_rejects_the_whole_set_for_one_invalid_value(plan):
+    client = parameterClient(plan)
+    writer = ParameterWriter(ParameterReader(client, plan=plan))
+    report = writer.apply({"P80": 0.05, "P84": 20}, current={})
+    assert report.rejected == ["P84"]
+    assert report.writes == 0 and client.requests == 0
+
+
+def test_write_frames_are_counted_by_function_code():
+    report = ScanReport("test")
+    report.addRequest(1, WriteSingleRegisterResponse(85, 40), WRITE_SINGLE_REGISTER)
+    assert (report.bytes_sent, report.bytes_received) == (8, 8)
+    report.addRequest(3, WriteMultipleRegistersResponse(80, 3), WRITE_MULTIPLE_REGISTERS)
+    assert (report.bytes_sent, report.bytes_received) == (8 + 15, 8 + 8)
@@ -0,0 +1,57 @@
+import json
+import time
+
+import pytest
+
+from memory_client import MemoryModbusClient
+from read_heat_pump_values import MeasValuesReader
+from pipeline import (WriterPipeline, MqttSink, LocalBroker, ScanBatch, Sample, createSinks, topicMatches,
+                      DROP_OLDEST, DROP_NEWEST)
+
+
+def scan(number):
+    return ScanBatch("MeasValues", float(number), [Sample("MeasValues", float(number), "C02", 20.0 + number, 40 + number, "Ambient temperature", 202)])
+
+
+def test_mqtt_sink_publishes_every_sample_retained(plan):
+    reader = MeasValuesReader(MemoryModbusClient({1: {address: address for address in range(300)}}), plan=plan)
+    reader.read()
+    broker = LocalBroker()
+    received = {}
+    broker.subscribe("nulite/MeasValues/+", lambda topic, payload: received.update({topic: json.loads(payload)}))
+    pipeline = WriterPipeline([MqttSink(broker)])
+    pipeline.submit(reader.batch())
+    pipeline.close()
+    assert len(received) == len(reader.register_map)
+    assert received["nulite/MeasValues/C17"]["raw"] == 217
+    # a late subscriber gets the retained values
+    late = []
+    broker.subscribe("nulite/#", lambda topic, payload: late.append(topic))
+    assert len(late) == len(reader.register_map)
+
+
+def test_topic_wildcards():
+    assert topicMatches("nulite/+/C02", "nulite/MeasValues/C02")
+    assert topicMatches("nulite/#", "nulite/MeasValues/C02")
+    assert not topicMatches("nulite/+", "nulite/MeasValues/C02")
+
+
+def test_mqtt_sink_needs_a_broker_address(tmp_path):
+    with pytest.raises(ValueError):
+        createSinks("csv,mqtt", str(tmp_path))
+
+
+@pytest.mark.parametrize("policy, kept", [(DROP_OLDEST, [0.0, 3.0, 4.0]), (DROP_NEWEST, [0.0, 1.0, 2.0])])
+def test_backpressure_keeps_polling_and_memory_bounded(policy, kept, blocked_sink):
+    sink = blocked_sink
+    pipeline = WriterPipeline([sink], max_queue=2, policy=policy)
+    pipeline.submit(scan(0))
+    # the writer thread holds the first scan, the queue takes two more
+    while pipeline.queue.qsize():
+        time.sleep(0.001)
+    for number in range(1, 5):
+        pipeline.submit(scan(number))
+    assert pipeline.dropped == 2
+    sink.release.set()
+    pipeline.close()
+    assert [batch.timestamp for batch in sink.batches] == kept
@@ -0,0 +1,66 @@
+import sys
+
+import pytest
+
+from memory_client import MemoryModbusClient
+from read_heat_pump_values import MeasValuesReader
+from read_planner import ReadPlanner, ScanReport
+from transport import AdaptiveTransport
+
+
+def registers(*addresses):
+    return [(address, f"C{address}", "", 0, 0) for address in addresses]
+
+
+def test_build_bridges_gaps_up_to_max_gap_and_max_count():
+    planner = ReadPlanner(registers(1, 2, 5, 20, 21, 30), max_gap=8, max_count=10)
+    assert [(request.start, request.count) for request in planner.requests] == [(1, 5), (20, 2), (30, 1)]
+    assert planner.size == 31
+
+
+def test_split_cuts_at_the_widest_hole():
+    planner = ReadPlanner(registers(10, 11, 14, 20, 21), max_gap=8)
+    halves = planner.split(planner.requests[0])
+    assert [(request.start, request.count) for request in halves] == [(10, 5), (20, 2)]
+    assert planner.requests == halves
+
+
+def test_an_illegal_address_is_bisected_out_of_the_plan():
+    # register 12 is planned but the device rejects it, the other registers of its request are still read
+    client = MemoryModbusClient({1: {address: 100 + address for address in range(20) if address != 12}})
+    planner = ReadPlanner(registers(10, 11, 12, 13, 14), max_gap=8)
+    transport = AdaptiveTransport(client, retries=0)
+    report = ScanReport("test")
+    image = planner.execute(transport, report)
+    assert report.splits == 2
+    assert [(request.start, request.count) for request in planner.requests] == [(10, 2), (13, 2)]
+    assert [image.valid[address] for address in range(10, 15)] == [1, 1, 0, 1, 1]
+    assert image[14] == 114
+    # the next scan uses the repaired plan without any rejected request
+    report = ScanReport("test")
+    planner.execute(transport, report)
+    assert (report.requests, report.splits, report.exceptions) == (2, 0, 0)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="the simulator runs on a pty")
+def test_a_device_limit_on_the_read_size_is_learned(plan):
+    # the vendor sheet allows 8 registers per read, a device that enforces it answers illegal data value
+    from pymodbus.client.sync import ModbusSerialClient
+    from simulator import NuliteSimulator
+    simulator = NuliteSimulator(plan, max_count=8).start()
+    client = ModbusSerialClient(method='rtu', port=simulator.port, baudrate=9600, parity='N')
+    client.connect()
+    try:
+        reader = MeasValuesReader(client, plan=plan)
+        reader.read()
+        assert all(reader.valid)
+        assert reader.report.splits > 0 and reader.report.failed == 0
+        assert reader.planner.max_count <= 8
+        assert all(request.count <= 8 for request in reader.planner.requests)
+        reader.read()
+        assert all(reader.valid)
+        assert (reader.report.splits, reader.report.exceptions) == (0, 0)
+        assert reader.report.requests == len(reader.planner.requests)
+    finally:
+        client.close()
+        simulator.stop()
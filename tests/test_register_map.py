@@ -0,0 +1,92 @@
+import json
+import random
+
+import pytest
+
+import register_map
+from bench_decode import legacy_decode
+from read_heat_pump_values import MeasValuesReader, ParameterReader
+from read_planner import RegisterImage
+from register_map import CompiledRegisterMap, RegisterMapError, exportRegisterPlan, loadRegisterPlan, validateRows
+
+
+def row(address, name, scale=0, offset=0, group="MeasValues", limits=None):
+    return (group, (address, name, f"register {name}", scale, offset), limits)
+
+
+def test_the_vendor_sheet_compiles(plan):
+    registers = {parameter[1]: parameter for parameter in plan.registers()}
+    # the data accuracy of C17 comes from the sheet, not from the old hand typed table
+    assert registers["C17"][3] == 0.1
+    assert registers["C02"][3] == 0.5 and registers["C13"][3] == 0
+    assert "P86" not in registers and "P87" not in registers
+    assert registers["C15"][2] == "Actual overheat degree of main expansion valve"
+    assert plan.ranges["P02"] == (10.0, 55.0)
+
+
+def test_valid_rows_are_sorted_into_groups():
+    plan = validateRows([row(201, "C01", 0.5), row(200, "C00"), row(0, "P00", group="Parameters", limits=(0, 1))])
+    assert [parameter[1] for parameter in plan.groups["MeasValues"]] == ["C00", "C01"]
+    assert plan.ranges == {"P00": (0, 1)}
+
+
+@pytest.mark.parametrize("rows, message", [
+    ([("MeasValues", (200, "C00", "too short"), None)], "expected 5 fields"),
+    ([row(200, "C00"), row(200, "C01")], "register 200 is already used by C00"),
+    ([row(200, "C00"), row(201, "C00")], "C00: duplicate register name"),
+    ([row(200, "C00", -0.5)], "implausible scale"),
+    ([row(200, "C00", 1000)], "implausible scale"),
+    ([row(200, "C00", float("nan"))], "implausible scale"),
+    ([row(200, "C00", 0, 40)], "is the scale a typo"),
+    ([row(0, "P00", group="Parameters", limits=(5, 1))], "range minimum 5 above maximum 1"),
+    ([row(0, "P00", group="Parameters"), row(10, "P10", group="Parameters"), row(5, "C05")], "overlap"),
+])
+def test_invalid_rows_are_rejected(rows, message):
+    with pytest.raises(RegisterMapError, match=message):
+        validateRows(rows)
+
+
+def test_the_compiled_plan_is_cached_by_the_hash_of_the_source(tmp_path, plan, monkeypatch):
+    source, cache_dir = tmp_path / "map.json", tmp_path / "cache"
+    exportRegisterPlan(plan, str(source))
+    monkeypatch.setattr(register_map, "_plans", {})
+    compiled = loadRegisterPlan(str(source), str(cache_dir))
+    assert len(list(cache_dir.glob("register_plan_*.pickle"))) == 1
+
+    # a new process finds the pickle and does not parse the source
+    def unparsable(path):
+        raise AssertionError("the source was parsed although it is cached")
+    monkeypatch.setattr(register_map, "_plans", {})
+    monkeypatch.setitem(register_map.LOADERS, ".json", unparsable)
+    cached = loadRegisterPlan(str(source), str(cache_dir))
+    assert cached.groups == compiled.groups and cached.ranges == compiled.ranges
+
+    # an edited source has another hash and is compiled again
+    monkeypatch.undo()
+    content = json.loads(source.read_text(encoding="utf-8"))
+    content["MeasValues"][0]["description"] = "edited"
+    source.write_text(json.dumps(content), encoding="utf-8")
+    monkeypatch.setattr(register_map, "_plans", {})
+    edited = loadRegisterPlan(str(source), str(cache_dir))
+    assert edited.groups["MeasValues"][0][2] == "edited"
+    assert len(list(cache_dir.glob("register_plan_*.pickle"))) == 2
+
+
+@pytest.mark.parametrize("reader_class", [ParameterReader, MeasValuesReader])
+def test_the_compiled_decode_matches_the_per_register_decode(plan, reader_class, decode_path):
+    reader = reader_class(None, plan=plan)
+    random.seed(0)
+    for _ in range(5):
+        image = RegisterImage(reader.planner.size)
+        image.store(0, [random.randrange(65536) for _ in range(reader.planner.size)])
+        reader.decode(image)
+        assert reader.data == legacy_decode(reader, image)
+
+
+def test_registers_that_were_not_read_stay_empty(decode_path):
+    compiled = CompiledRegisterMap([(1, "C02", "temperature", 0.5, 0), (3, "C13", "state", 0, 0)])
+    image = RegisterImage(4)
+    image.store(1, [0xFFFF])
+    raw, values, valid = compiled.decode(image)
+    assert [bool(value) for value in valid] == [True, False]
+    assert compiled.formatRows(raw, values, valid) == ["C02, -0.50, temperature, 1, 65535", "C13, , state, 3, "]
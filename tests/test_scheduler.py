@@ -0,0 +1,18 @@
+from memory_client import MemoryModbusClient
+from read_heat_pump_values import MeasValuesReader, ParameterReader
+from scheduler import ScanGroup, Scheduler
+from transport import deviceTransport
+
+
+def test_errors_of_a_shared_scan_are_counted_once(tmp_path, plan):
+    # unit 1 does not answer, every transaction of the combined scan times out
+    client = MemoryModbusClient({}, timeout=0.001)
+    transport = deviceTransport(client)
+    transport.retries, transport.backoff = 1, 0
+    groups = [ScanGroup(MeasValuesReader(client, plan=plan), 10), ScanGroup(ParameterReader(client, plan=plan), 10)]
+    scheduler = Scheduler(client, groups, str(tmp_path), clock=lambda: 0.0)
+    scheduler.tick(0.0)
+    assert scheduler.scans == 1
+    assert scheduler.timeouts == client.requests
+    assert scheduler.retries == client.requests // 2
+    assert [group.failures for group in groups] == [1, 1]
@@ -0,0 +1,54 @@
+import sys
+
+import pytest
+
+from bench_scan import PLANS, benchmark
+from read_heat_pump_values import MeasValuesReader, ParameterReader
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="the simulator runs on a pty")
+
+
+@pytest.fixture
+def simulator(plan):
+    from simulator import NuliteSimulator
+    simulator = NuliteSimulator(plan).start()
+    yield simulator
+    simulator.stop()
+
+
+def connect(simulator):
+    from pymodbus.client.sync import ModbusSerialClient
+    client = ModbusSerialClient(method='rtu', port=simulator.port, baudrate=9600, parity='N')
+    client.connect()
+    return client
+
+
+def test_a_readout_of_the_simulator_is_complete(plan, simulator):
+    client = connect(simulator)
+    try:
+        parameters, meas_values = ParameterReader(client, plan=plan), MeasValuesReader(client, plan=plan)
+        for reader in (parameters, meas_values):
+            reader.read()
+            assert all(reader.valid) and reader.report.failed == 0
+        # settings sit in the middle of their adjustment range
+        assert parameters.values[parameters.register_map.names.index("P02")] == 32
+        # the frame sizes of the scan report match what went over the line
+        reports = (parameters.report, meas_values.report)
+        assert simulator.requests == sum(report.requests for report in reports)
+        assert simulator.bytes_received == sum(report.bytes_sent for report in reports)
+        assert simulator.bytes_sent == sum(report.bytes_received for report in reports)
+    finally:
+        client.close()
+
+
+def test_the_coalesced_plan_needs_fewer_requests_than_blocks(plan, simulator):
+    results = {}
+    for name, (max_gap, max_count) in PLANS.items():
+        client = connect(simulator)
+        try:
+            results[name] = benchmark(MeasValuesReader(client, max_gap, max_count, plan=plan), 2)
+        finally:
+            client.close()
+    assert results["coalesced"]["failures"] == results["blocks"]["failures"] == 0
+    assert results["coalesced"]["requests_per_scan"] < results["blocks"]["requests_per_scan"]
+    assert results["coalesced"]["bytes_per_scan"] < results["blocks"]["bytes_per_scan"]
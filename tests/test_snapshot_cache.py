@@ -0,0 +1,132 @@
+import pytest
+
+from memory_client import MemoryModbusClient
+from pipeline import CsvSink, WriterPipeline, ScanBatch
+from read_heat_pump_values import MeasValuesReader, ParameterReader
+from register_map import CompiledRegisterMap
+from snapshot_cache import SnapshotCache
+
+REGISTERS = [(1, "C02", "temperature", 0.5, 0), (2, "C13", "state", 0, 0)]
+
+
+class FailingSink():
+    def write(self, batches):
+        raise OSError("disk full")
+
+    def close(self):
+        pass
+
+
+def scan(cache, register_map, values, timestamp, valid=None):
+    valid = valid if valid is not None else [True] * len(values)
+    indices = cache.changes("MeasValues", register_map, values, values, valid, timestamp)
+    written = None
+    if indices is not None:
+        written = lambda: cache.commit("MeasValues", register_map, values, valid, timestamp, indices)
+    return indices, written
+
+
+def persisted(cache, register_map, values, timestamp, valid=None):
+    indices, written = scan(cache, register_map, values, timestamp, valid)
+    if written is not None:
+        written()
+    return indices
+
+
+@pytest.fixture
+def register_map():
+    return CompiledRegisterMap(REGISTERS)
+
+
+def test_one_temperature_step_is_dropped_two_are_kept(tmp_path, register_map):
+    cache = SnapshotCache(str(tmp_path / "snapshots.json"))
+    assert persisted(cache, register_map, [40.0, 1], 0) == [0, 1]
+    assert persisted(cache, register_map, [40.5, 1], 10) is None
+    assert persisted(cache, register_map, [39.5, 1], 20) is None
+    assert persisted(cache, register_map, [41.0, 1], 30) == [0]
+    # status values have no deadband
+    assert persisted(cache, register_map, [41.0, 2], 40) == [1]
+    assert cache.skipped == 2
+
+
+def test_a_slow_drift_gets_through(tmp_path, register_map):
+    # the reference stays at the last persisted value, so steps within the deadband add up
+    cache = SnapshotCache(str(tmp_path / "snapshots.json"))
+    persisted(cache, register_map, [40.0, 1], 0)
+    results = [persisted(cache, register_map, [40.0 + 0.5 * step, 1], 10 * step) for step in range(1, 5)]
+    assert results == [None, [0], None, [0]]
+
+
+def test_deadbands_can_be_overridden(tmp_path, register_map):
+    cache = SnapshotCache(str(tmp_path / "snapshots.json"), deadbands={"C02": 2.0, "C13": 1})
+    persisted(cache, register_map, [40.0, 1], 0)
+    assert persisted(cache, register_map, [42.0, 2], 10) is None
+    assert persisted(cache, register_map, [42.5, 2], 20) == [0]
+
+
+def test_a_register_that_could_not_be_read_is_a_change(tmp_path, register_map):
+    cache = SnapshotCache(str(tmp_path / "snapshots.json"))
+    persisted(cache, register_map, [40.0, 1], 0)
+    assert persisted(cache, register_map, [0.0, 1], 10, [False, True]) == [0]
+    assert persisted(cache, register_map, [40.0, 1], 20) == [0]
+
+
+def test_a_keyframe_is_written_every_interval(tmp_path, register_map):
+    cache = SnapshotCache(str(tmp_path / "snapshots.json"), keyframe_interval=60)
+    assert persisted(cache, register_map, [40.0, 1], 0) == [0, 1]
+    assert persisted(cache, register_map, [40.0, 1], 59) is None
+    assert persisted(cache, register_map, [40.0, 1], 60) == [0, 1]
+    assert persisted(cache, register_map, [40.0, 1], 119) is None
+    # a changed register map starts with a keyframe as well
+    assert persisted(cache, CompiledRegisterMap(REGISTERS[:1]), [40.0], 120) == [0]
+
+
+def test_a_scan_that_was_not_written_is_compared_again(tmp_path, register_map, sink):
+    cache = SnapshotCache(str(tmp_path / "snapshots.json"))
+    indices, written = scan(cache, register_map, [40.0, 1], 0)
+    written()
+    indices, written = scan(cache, register_map, [42.0, 1], 10)
+    assert indices == [0]
+    # the sink fails, the change is not committed and is found again by the next scan
+    pipeline = WriterPipeline([FailingSink()])
+    pipeline.submit(ScanBatch("MeasValues", 10, [], written=written))
+    pipeline.close()
+    assert scan(cache, register_map, [42.0, 1], 20)[0] == [0]
+    pipeline = WriterPipeline([sink])
+    pipeline.submit(ScanBatch("MeasValues", 20, [], written=scan(cache, register_map, [42.0, 1], 20)[1]))
+    pipeline.close()
+    assert scan(cache, register_map, [42.0, 1], 30)[0] is None
+    assert SnapshotCache(str(tmp_path / "snapshots.json")).snapshots["MeasValues"]["values"] == [42.0, 1.0]
+
+
+def test_unchanged_parameters_are_not_persisted(tmp_path, plan, sink):
+    client = MemoryModbusClient({1: {address: 1 for address in range(100)}})
+    reader = ParameterReader(client, plan=plan)
+    reader.snapshots = SnapshotCache(str(tmp_path / "snapshots.json"))
+    for value in (1, 1, 2):
+        client.units[1][2] = value
+        reader.read()
+        reader.pipeline = WriterPipeline([sink])
+        reader.persist(str(tmp_path))
+        # the writer commits the snapshot, the next scan is compared against it
+        reader.pipeline.close()
+    assert [len(batch.samples) for batch in sink.batches] == [len(reader.registers)] * 2
+    assert reader.snapshots.skipped == 1
+
+
+def test_the_csv_of_a_scan_holds_only_the_changes(tmp_path, plan):
+    client = MemoryModbusClient({1: {address: 80 for address in range(200, 300)}})
+    reader = MeasValuesReader(client, plan=plan)
+    reader.snapshots = SnapshotCache(str(tmp_path / "snapshots.json"))
+    output = tmp_path / "output"
+    output.mkdir()
+    for changes in ({}, {202: 81, 213: 3}):
+        client.units[1].update(changes)
+        reader.read()
+        reader.pipeline = WriterPipeline([CsvSink(str(output))])
+        reader.persist(str(output))
+        reader.pipeline.close()
+    full, delta = [path.read_text().splitlines() for path in sorted(output.glob("MeasValues_*.csv"), key=lambda path: (len(path.name), path.name))]
+    assert len(full) == len(reader.registers) + 1
+    # C02 moved by one 0.5 degC step, only the status value C13 is written
+    assert delta[1:] == ["C13, 3, " + reader.register_map.descriptions[reader.register_map.names.index("C13")] + ", 213, 3"]
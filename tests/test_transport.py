@@ -0,0 +1,117 @@
+import sys
+
+import pytest
+
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+
+from memory_client import MemoryModbusClient
+from metrics import Metrics
+from read_planner import ReadPlanner, ScanReport
+from transport import AdaptiveTransport
+
+simulated = pytest.mark.skipif(sys.platform == "win32", reason="the simulator runs on a pty")
+
+
+class FlakyClient(MemoryModbusClient):
+    # the first reads and every read of the given start addresses get no response
+    def __init__(self, units, lost=0, dead=()):
+        super().__init__(units)
+        self.lost = lost
+        self.dead = dead
+
+    def read_holding_registers(self, address, count, unit=1):
+        if self.lost > 0 or address in self.dead:
+            self.lost = max(self.lost - 1, 0)
+            self.requests += 1
+            return ModbusIOException(f"no response from unit {unit}")
+        return super().read_holding_registers(address, count, unit)
+
+
+def simulatedClient(plan, **options):
+    from pymodbus.client.sync import ModbusSerialClient
+    from simulator import NuliteSimulator
+    simulator = NuliteSimulator(plan, **options).start()
+    client = ModbusSerialClient(method='rtu', port=simulator.port, baudrate=9600, parity='N')
+    client.connect()
+    return simulator, client
+
+
+@simulated
+@pytest.mark.parametrize("options, timeouts, crc_errors", [({"timeout_rate": 1.0}, 2, 0), ({"crc_error_rate": 1.0}, 0, 2)])
+def test_timeouts_and_crc_errors_are_told_apart(plan, options, timeouts, crc_errors):
+    simulator, client = simulatedClient(plan, **options)
+    try:
+        transport = AdaptiveTransport(client, retries=1, backoff=0.0, max_timeout=0.3)
+        # the second read runs into the no response bookkeeping of pymodbus
+        for _ in range(2):
+            report = ScanReport("test")
+            response = transport.read(200, 10, report)
+            assert response.isError()
+            assert (report.timeouts, report.crc_errors) == (timeouts, crc_errors)
+    finally:
+        client.close()
+        simulator.stop()
+
+
+@simulated
+def test_missed_widens_the_timeout_after_every_timeout(plan):
+    simulator, client = simulatedClient(plan)
+    try:
+        transport = AdaptiveTransport(client, retries=0, max_timeout=3.0)
+        transport.read(200, 10, ScanReport("test"))
+        deviation = transport.deviation
+        simulator.timeout_rate = 1.0
+        for _ in range(2):
+            transport.read(200, 10, ScanReport("test"))
+            assert transport.deviation > deviation
+            deviation = transport.deviation
+    finally:
+        client.close()
+        simulator.stop()
+
+
+def test_a_lost_response_is_retried():
+    client = FlakyClient({1: {address: address for address in range(20)}}, lost=2)
+    transport = AdaptiveTransport(client, retries=2, backoff=0.0)
+    report = ScanReport("test")
+    response = transport.read(5, 3, report)
+    assert response.registers == [5, 6, 7]
+    assert (report.requests, report.retries, report.timeouts) == (3, 2, 2)
+
+
+def test_an_illegal_address_is_not_retried():
+    client = MemoryModbusClient({1: {address: address for address in range(20)}})
+    transport = AdaptiveTransport(client, retries=2, backoff=0.0)
+    report = ScanReport("test")
+    response = transport.read(18, 4, report)
+    assert response.exception_code == 0x02
+    assert (report.requests, report.retries, report.exceptions) == (1, 0, 1)
+
+
+@pytest.mark.parametrize("exception_code, requests", [(0x06, 3), (0x03, 1), (0x04, 1)])
+def test_only_a_busy_slave_is_retried(exception_code, requests):
+    client = FlakyClient({1: {}})
+    client.read_holding_registers = lambda address, count, unit=1: ExceptionResponse(0x03, exception_code)
+    metrics = Metrics()
+    transport = AdaptiveTransport(client, retries=2, backoff=0.0)
+    transport.metrics = metrics
+    report = ScanReport("test")
+    assert transport.read(0, 8, report).exception_code == exception_code
+    assert (report.requests, report.retries, report.exceptions) == (requests, requests - 1, requests)
+    # the scan report and the metric count the same exception responses
+    labels = (("reader", "test"), ("unit", 1), ("code", exception_code))
+    assert metrics.values[("nulite_exception_responses_total", labels)] == report.exceptions
+
+
+def test_a_block_without_response_leaves_a_partial_scan():
+    registers = [(address, f"C{address}", "", 0, 0) for address in (10, 11, 12, 40, 41)]
+    client = FlakyClient({1: {address: 100 + address for address in range(50)}}, dead=(40,))
+    planner = ReadPlanner(registers, max_gap=8)
+    report = ScanReport("test")
+    image = planner.execute(AdaptiveTransport(client, retries=1, backoff=0.0), report)
+    assert [image.valid[address] for address in (10, 11, 12, 40, 41)] == [1, 1, 1, 0, 0]
+    assert image[12] == 112
+    assert (report.requests, report.retries, report.timeouts, report.failed) == (3, 1, 2, 1)
+    # the failed block stays in the plan for the next scan
+    assert len(planner.requests) == 2
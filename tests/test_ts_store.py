@@ -0,0 +1,21 @@
+from read_planner import RegisterImage
+from register_map import CompiledRegisterMap
+from ts_store import TimeSeriesStore, exportLegacyCsv, exportWideCsv
+
+REGISTERS = [(1, "C02", "temperature", 0.1, 0), (2, "C03", "negative temperature", 0.5, -30), (3, "C13", "state", 0, 0)]
+
+
+def test_stored_scans_decode_like_the_live_scan(tmp_path, decode_path):
+    register_map = CompiledRegisterMap(REGISTERS)
+    image = RegisterImage(4)
+    image.store(1, [215, 0xFFF6, 7])
+    raw, values, valid = register_map.decode(image)
+    assert [round(float(value), 2) for value in values] == [21.5, -20.0, 7]
+
+    store = TimeSeriesStore(str(tmp_path / "store"))
+    store.append("MeasValues", register_map, 1700000000.0, raw, valid)
+    assert exportLegacyCsv(store, "MeasValues", str(tmp_path)) == 1
+    legacy = next(tmp_path.glob("MeasValues_*.csv")).read_text().splitlines()[1:]
+    assert legacy == register_map.formatRows(raw, values, valid)
+    exportWideCsv(store, "MeasValues", str(tmp_path / "wide.csv"))
+    assert (tmp_path / "wide.csv").read_text().splitlines()[1].split(", ")[1:] == ["21.50", "-20.00", "7"]